@@ -0,0 +1,287 @@
+"""Benchmarks for spacenavigator, which run without any hardware attached.
+
+Usage:
+    python benchmark.py [all|process|dispatch|pipeline] [--device NAME] [-n N]
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.25
+
+Synthetic raw reports are generated for every (vendor ID, product ID) in
+device_specs (or just the specs named with --device), laid out as the real
+device sends them: translation and rotation on two channels or one, plus button
+reports. "process" feeds them straight to DeviceSpec.process(); "dispatch" goes
+through open() and a SimulatedTransport with callbacks attached. Each result is
+the best or median of --repeat runs. With --baseline, exits with status 1 if any
+result is worse than the baseline by more than the tolerance.
+"""
+import argparse
+import copy
+import json
+import math
+import random
+import statistics
+import sys
+import timeit
+import tracemalloc
+from array import array
+
+import spacenavigator
+
+
+def spec_ids(names=None):
+    """The (vendor ID, product ID) pairs in device_specs, or those of the named specs"""
+    specs = spacenavigator.device_specs
+    ids = specs.hid_ids()
+    if names is not None:
+        ids = [hid_id for hid_id in ids if specs.by_id(*hid_id).name in names]
+    return ids
+
+
+def label(hid_id):
+    """Name a result by its spec and IDs, as several IDs can share a spec name"""
+    return "%s %04x:%04x" % ((spacenavigator.device_specs.by_id(*hid_id).name,) + tuple(hid_id))
+
+
+def random_state(rng):
+    """A compact state vector with random axes"""
+    axes = [rng.uniform(-1.0, 1.0) for i in range(spacenavigator.AXIS_COUNT)]
+    return array("d", [0.0] + axes + [0.0])
+
+
+def report_length(spec, channel):
+    """Length of the reports on channel, from the highest byte the spec reads"""
+    used = [max(a.byte1, a.byte2) for a in spec.mappings.values() if a.channel == channel]
+    used += [b.byte for b in spec.button_mapping if b.channel == channel]
+    return max(used) + 1
+
+
+def synthetic_reports(spec, samples, rng, button_every=50):
+    """Generate raw reports for samples physical samples of smooth 6DOF motion.
+
+    Each sample produces one report per axis channel, in channel order, as the
+    devices send them; a report on each button channel, with random buttons
+    held, is added every button_every samples.
+    """
+    axis_channels = sorted(set(a.channel for a in spec.mappings.values()))
+    button_channels = sorted(set(b.channel for b in spec.button_mapping))
+    lengths = {c: report_length(spec, c) for c in axis_channels + button_channels}
+    phases = {name: rng.uniform(0, 2 * math.pi) for name in spec.mappings}
+    reports = []
+    for i in range(samples):
+        for channel in axis_channels:
+            report = bytearray(lengths[channel])
+            report[0] = channel
+            for name, axis in spec.mappings.items():
+                if axis.channel == channel:
+                    value = int(spec.axis_scale * math.sin(i * 0.01 + phases[name]))
+                    report[axis.byte1] = value & 0xFF
+                    report[axis.byte2] = (value >> 8) & 0xFF
+            reports.append(bytes(report))
+        if i % button_every == 0:
+            for channel in button_channels:
+                report = bytearray(lengths[channel])
+                report[0] = channel
+                for b in spec.button_mapping:
+                    if b.channel == channel and rng.random() < 0.3:
+                        report[b.byte] |= 1 << b.bit
+                reports.append(bytes(report))
+    return reports
+
+
+def measure(feed, reports, repeat=5):
+    """Measure feeding reports, one at a time, to feed(report)
+
+    Returns:
+        dict of reports_per_s (best of repeat runs), per-report latency p50_ns
+        and p99_ns (median of repeat runs), and peak_bytes allocated during a run
+        and retained_bytes_per_report (least of repeat runs)
+    """
+
+    def run():
+        for report in reports:
+            feed(report)
+
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+
+    clock_ns = spacenavigator.clock_ns
+    p50, p99, peaks, retained = [], [], [], []
+    for i in range(repeat):
+        histogram = spacenavigator.LatencyHistogram()
+        for report in reports:
+            start = clock_ns()
+            feed(report)
+            histogram.record(clock_ns() - start)
+        p50.append(histogram.percentile(50))
+        p99.append(histogram.percentile(99))
+
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        run()
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak - before)
+        retained.append(max(0, after - before) / float(len(reports)))
+
+    return {
+        "reports_per_s": len(reports) / best,
+        "p50_ns": statistics.median(p50),
+        "p99_ns": statistics.median(p99),
+        "peak_bytes": min(peaks),
+        "retained_bytes_per_report": min(retained),
+    }
+
+
+def benchmark_process(hid_ids, samples=10000, repeat=5):
+    """Feed synthetic reports straight to DeviceSpec.process(), with no callbacks"""
+    results = {}
+    for hid_id in hid_ids:
+        spec = spacenavigator.device_specs.by_id(*hid_id)
+        reports = synthetic_reports(spec, samples, random.Random(0))
+        results[label(hid_id)] = measure(copy.deepcopy(spec).process, reports, repeat)
+    return results
+
+
+def benchmark_dispatch(hid_ids, samples=10000, repeat=5):
+    """Feed synthetic reports through open() and a SimulatedTransport, to callbacks"""
+
+    def callback(state):
+        pass
+
+    def button_callback(state, buttons):
+        pass
+
+    results = {}
+    for hid_id in hid_ids:
+        name = spacenavigator.device_specs.by_id(*hid_id).name
+        transport = spacenavigator.SimulatedTransport()
+        # add_device() takes a name, which may be shared by several IDs
+        simulated = spacenavigator.SimulatedDevice(hid_id[0], hid_id[1], name, path="simulated")
+        transport.devices.append(simulated)
+        device = spacenavigator.open(
+            callback=callback,
+            button_callback=button_callback,
+            device=name,
+            transport=transport,
+        )
+        reports = synthetic_reports(device, samples, random.Random(0))
+        results[label(hid_id)] = measure(simulated.emit, reports, repeat)
+        device.close()
+    return results
+
+
+def benchmark_pipeline(n=100000, repeat=5):
+    """Measure the throughput of input shaping pipelines applied to random states
+
+    Returns:
+        dict mapping pipeline name -> {"states_per_s": states per second (best of repeat)}
+    """
+    pipelines = {
+        "deadzone": [spacenavigator.Deadzone(0.1)],
+        "expo": [spacenavigator.Expo(0.5)],
+        "ema": [spacenavigator.EMA(0.3)],
+        "one_euro": [spacenavigator.OneEuro(1.0, 0.5)],
+        "dominant": [spacenavigator.DominantAxis()],
+        "full": [
+            spacenavigator.Deadzone(0.1),
+            spacenavigator.Expo(0.5),
+            spacenavigator.OneEuro(1.0, 0.5),
+            spacenavigator.DominantAxis(),
+        ],
+    }
+    rng = random.Random(0)
+    states = [random_state(rng) for i in range(1000)]
+
+    results = {}
+    for name, stages in pipelines.items():
+        pipeline = spacenavigator.Pipeline(copy.deepcopy(stages))
+
+        def run():
+            pipeline.reset()
+            for i in range(n):
+                state = states[i % len(states)]
+                # 1kHz reports
+                state[0] = i * 0.001
+                pipeline.apply(state)
+
+        best = min(timeit.repeat(run, number=1, repeat=repeat))
+        results[name] = {"states_per_s": n / best}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare results against a baseline produced by --save-baseline
+
+    Rates (metrics ending _per_s) regress if they fall by more than tolerance;
+    latencies and memory regress if they grow by more than tolerance.
+
+    Returns:
+        list of (benchmark, name, metric, baseline value, current value)
+    """
+    regressions = []
+    for benchmark, entries in baseline.items():
+        for name, metrics in entries.items():
+            current = results.get(benchmark, {}).get(name)
+            if current is None:
+                continue
+            for metric, old in metrics.items():
+                new = current.get(metric)
+                if new is None or old <= 0:
+                    continue
+                if metric.endswith("_per_s"):
+                    worse = new < old * (1.0 - tolerance)
+                else:
+                    worse = new > old * (1.0 + tolerance)
+                if worse:
+                    regressions.append((benchmark, name, metric, old, new))
+    return regressions
+
+
+def print_results(title, results):
+    print(title)
+    for name, metrics in results.items():
+        values = "  ".join("%s=%.4g" % item for item in metrics.items())
+        print("  %-40s %s" % (name, values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "benchmark", nargs="?", default="all", choices=["all", "process", "dispatch", "pipeline"]
+    )
+    parser.add_argument("--device", action="append", help="only benchmark this device spec")
+    parser.add_argument("-n", type=int, default=10000, help="physical samples per device")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="runs per result, taking the best or median"
+    )
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="allowed fractional regression"
+    )
+    args = parser.parse_args()
+
+    hid_ids = spec_ids(args.device)
+    results = {}
+    if args.benchmark in ("all", "process"):
+        results["process"] = benchmark_process(hid_ids, args.n, args.repeat)
+        print_results("DeviceSpec.process()", results["process"])
+    if args.benchmark in ("all", "dispatch"):
+        results["dispatch"] = benchmark_dispatch(hid_ids, args.n, args.repeat)
+        print_results("open() + SimulatedTransport dispatch", results["dispatch"])
+    if args.benchmark in ("all", "pipeline"):
+        results["pipeline"] = benchmark_pipeline(args.n * 10, args.repeat)
+        print_results("Input shaping pipelines", results["pipeline"])
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for benchmark, name, metric, old, new in regressions:
+            print("REGRESSION %s %s %s: %.4g -> %.4g" % (benchmark, name, metric, old, new))
+        if regressions:
+            sys.exit(1)
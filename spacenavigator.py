@@ -1,15 +1,29 @@
-from time import sleep
-import pywinusb.hid as hid
+from time import sleep, perf_counter, perf_counter_ns, monotonic, monotonic_ns, get_clock_info
 from collections import namedtuple
-import timeit
+from collections.abc import MutableMapping
 import copy
-from pywinusb.hid import usage_pages, helpers, winapi
+import math
+import struct
+import threading
+import mmap
+import io
+import os
+import sys
+import errno
+import selectors
+from collections import deque
+from array import array
 
 # current version number
 __version__ = "0.2.3"
 
-# clock for timing
-high_acc_clock = timeit.default_timer
+# clocks for timing: high_acc_clock in seconds, clock_ns in integer nanoseconds,
+# on the same timebase. The monotonic clock is used unless it is coarse (as on
+# Windows before Python 3.12).
+if get_clock_info("monotonic").resolution <= 1e-6:
+    high_acc_clock, clock_ns = monotonic, monotonic_ns
+else:
+    high_acc_clock, clock_ns = perf_counter, perf_counter_ns
 
 
 GENERIC_PAGE = 0x1
@@ -17,6 +31,10 @@ BUTTON_PAGE = 0x9
 LED_PAGE = 0x8
 MULTI_AXIS_CONTROLLER_CAP = 0x8
 
+# output report which drives the LED on 3Dconnexion devices, for transports
+# which write raw reports rather than setting HID usages
+LED_REPORT_ID = 0x4
+
 HID_AXIS_MAP = {
     0x30: "x",
     0x31: "y",
@@ -26,197 +44,2542 @@ HID_AXIS_MAP = {
     0x35: "yaw",
 }
 
-import pprint
+# generic desktop usage -> (axis, scale) for specs derived from report
+# descriptors, matching the orientation of the built-in specs
+DESCRIPTOR_AXES = {
+    0x30: ("x", 1),
+    0x31: ("y", -1),
+    0x32: ("z", -1),
+    0x33: ("pitch", -1),
+    0x34: ("roll", -1),
+    0x35: ("yaw", 1),
+}
+
+# axis mappings are specified as:
+# [channel, byte1, byte2, scale]; scale is usually just -1 or 1 and multiplies the result by this value
+# (but per-axis scaling can also be achieved by setting this value)
+# byte1 and byte2 are indices into the HID array indicating the two bytes to read to form the value for this axis
+# For the SpaceNavigator, these are consecutive bytes following the channel number.
+AxisSpec = namedtuple("AxisSpec", ["channel", "byte1", "byte2", "scale"])
+
+
+# button states are specified as:
+# [channel, data byte,  bit of byte, index to write to]
+# If a message is received on the specified channel, the value of the data byte is set in the button bit array
+ButtonSpec = namedtuple("ButtonSpec", ["channel", "byte", "bit"])
+
+
+## Simple HID code to read data from the 3dconnexion devices
+
+# convert two 8 bit bytes to a signed 16 bit integer
+def to_int16(y1, y2):
+    x = (y1) | (y2 << 8)
+    if x >= 32768:
+        x = -(65536 - x)
+    return x
+
+
+# tuple for 6DOF results
+SpaceNavigator = namedtuple(
+    "SpaceNavigator", ["t", "x", "y", "z", "roll", "pitch", "yaw", "buttons"]
+)
+
+# layout of the compact state vector: the SpaceNavigator fields, with the
+# buttons packed into an integer bitmask (bit i is button i)
+STATE_FIELDS = SpaceNavigator._fields
+STATE_INDEX = {name: index for index, name in enumerate(STATE_FIELDS)}
+
+
+def hex_serial(serial_number):
+    """Convert a HID serial number string to the hex id used as DeviceSpec.serial_number"""
+    return "".join(["%02X" % ord(char) for char in serial_number])
+
+
+class ButtonState(list):
+    def __int__(self):
+        # button 0 is the most significant bit
+        value = 0
+        for b in self:
+            value = (value << 1) | b
+        return value
+
+
+# the bits of each byte value, least significant first
+_BYTE_BITS = [tuple((value >> bit) & 1 for bit in range(8)) for value in range(256)]
+
+
+def button_state(mask, n_buttons):
+    """Expand a button bitmask (bit i set if button i is pressed) into a ButtonState"""
+    bits = []
+    for shift in range(0, n_buttons, 8):
+        bits.extend(_BYTE_BITS[(mask >> shift) & 0xFF])
+    return ButtonState(bits[:n_buttons])
+
+
+# a press or release of one button; mask is the bitmask of all buttons after it
+ButtonEvent = namedtuple("ButtonEvent", ["t", "button", "pressed", "mask"])
+
+
+def compile_decoders(mappings, button_mapping, axis_scale):
+    """Compile axis and button mappings into a dispatch table keyed by report ID.
+
+    Each channel gets a single precompiled struct.Struct which unpacks all of
+    its axes in one call, a matching vector of divisors which map the raw
+    int16 values to [-1.0, 1.0], and a list of (button bit, byte, mask) triples
+    for the buttons on that channel. Axes are identified by their index in the
+    compact state vector (see STATE_INDEX). Axes whose two bytes are not a
+    consecutive little-endian pair can't be unpacked by the struct, and are
+    decoded with to_int16 instead.
+
+    Buttons are decoded with a 256 entry table for each byte which carries
+    them, mapping the byte's value to the bits of the button bitmask it sets.
+
+    Returns:
+        dict mapping channel -> (unpacker, indices, divisors, extra_axes, buttons)
+        unpacker is None if the channel carries no packable axes. buttons is
+        None, or (channel mask, ((byte, table), ...)) where channel mask has
+        the bits of the buttons on this channel.
+    """
+    channels = {}
+    for name, (chan, b1, b2, flip) in mappings.items():
+        channels.setdefault(chan, ([], {}))[0].append((b1, b2, name, flip))
+    for index, (chan, byte, bit) in enumerate(button_mapping):
+        byte_buttons = channels.setdefault(chan, ([], {}))[1].setdefault(byte, [])
+        byte_buttons.append((1 << index, 1 << bit))
+
+    decoders = {}
+    for chan, (axes, buttons) in channels.items():
+        fmt, pos = "<", 0
+        indices, divisors, extra_axes = [], [], []
+        for b1, b2, name, flip in sorted(axes):
+            divisor = float(axis_scale) / flip
+            if b2 == b1 + 1 and b1 >= pos:
+                # pad up to the first byte of this axis, then read an int16
+                fmt += "%dxh" % (b1 - pos) if b1 > pos else "h"
+                pos = b1 + 2
+                indices.append(STATE_INDEX[name])
+                divisors.append(divisor)
+            else:
+                extra_axes.append((STATE_INDEX[name], b1, b2, divisor))
+        unpacker = struct.Struct(fmt) if indices else None
+        tables, channel_mask = [], 0
+        for byte, bits in sorted(buttons.items()):
+            table = [0] * 256
+            for button_bit, mask in bits:
+                channel_mask |= button_bit
+                for value in range(256):
+                    if value & mask:
+                        table[value] |= button_bit
+            tables.append((byte, tuple(table)))
+        decoders[chan] = (
+            unpacker,
+            tuple(indices),
+            tuple(divisors),
+            tuple(extra_axes),
+            (channel_mask, tuple(tables)) if tables else None,
+        )
+    return decoders
+
+
+class SampleHistory(object):
+    """Fixed-capacity ring buffer of device states.
+
+    Each sample is stored as a row (t, x, y, z, roll, pitch, yaw, buttons) of a
+    preallocated (capacity, 8) float64 NumPy array; buttons is the integer
+    bitmask from DeviceSpec.snapshot(). Requires NumPy.
+    """
+
+    def __init__(self, capacity):
+        import numpy as np
+
+        self._np = np
+        self.capacity = int(capacity)
+        self._buffer = np.zeros((self.capacity, len(STATE_FIELDS)))
+        self._lock = threading.Lock()
+        # total number of samples ever written, and the value of that count
+        # at the last drain()
+        self._written = 0
+        self._drained = 0
+        # number of samples overwritten before they could be drained
+        self.overflowed = 0
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    def append(self, state):
+        """Append one state vector to the buffer, overwriting the oldest if full"""
+        with self._lock:
+            self._buffer[self._written % self.capacity] = state
+            self._written += 1
+
+    def _copy_range(self, start, stop):
+        # copy samples [start, stop) (counted in samples written) in time order
+        start = max(start, stop - self.capacity)
+        i, j = start % self.capacity, stop % self.capacity
+        if stop - start == 0:
+            return self._buffer[:0].copy()
+        if i < j:
+            return self._buffer[i:j].copy()
+        return self._np.concatenate((self._buffer[i:], self._buffer[:j]))
+
+    def history(self, n=None):
+        """Return the most recent n samples (all buffered samples if n is None)
+
+        Returns:
+            (N, 8) array, oldest sample first. N may be less than n if fewer
+            samples are buffered.
+        """
+        with self._lock:
+            stop = self._written
+            start = 0 if n is None else stop - n
+            return self._copy_range(max(start, 0), stop)
+
+    def drain(self):
+        """Return all samples written since the last drain(), oldest first.
+
+        Samples which were overwritten before being drained are counted in
+        overflowed.
+
+        Returns:
+            (N, 8) array
+        """
+        with self._lock:
+            start, stop = self._drained, self._written
+            self.overflowed += max(0, stop - start - self.capacity)
+            self._drained = stop
+            return self._copy_range(start, stop)
+
+    def clear(self):
+        """Discard all buffered samples"""
+        with self._lock:
+            self._drained = self._written
+
+
+# what a bounded queue does when a new state arrives and it is full:
+#   drop_oldest: discard the oldest queued state
+#   conflate:    discard every queued state, so only the latest is kept
+#   block:       block the reader thread until the consumer catches up
+OVERFLOW_POLICIES = ("drop_oldest", "conflate", "block")
+
+
+def check_overflow_policy(overflow):
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError(
+            "overflow must be one of %s, not %r" % (", ".join(OVERFLOW_POLICIES), overflow)
+        )
+
+
+class EventQueue(object):
+    """Thread-safe bounded queue with an overflow policy (see OVERFLOW_POLICIES).
+
+    Counts the items queued and the items dropped by the overflow policy.
+    """
+
+    def __init__(self, maxsize=64, overflow="drop_oldest"):
+        check_overflow_policy(overflow)
+        self.maxsize = max(1, maxsize)
+        self.overflow = overflow
+        self.queued = 0
+        self.dropped = 0
+        self.closed = False
+        self._items = deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """Add an item, applying the overflow policy if the queue is full"""
+        with self._cond:
+            if self.closed:
+                return
+            if self.overflow == "conflate":
+                self.dropped += len(self._items)
+                self._items.clear()
+            elif len(self._items) >= self.maxsize:
+                if self.overflow == "drop_oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.maxsize and not self.closed:
+                        self._cond.wait()
+            self._items.append(item)
+            self.queued += 1
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Remove and return the oldest item, waiting up to timeout seconds for one
+
+        Returns:
+            the item, or None if the timeout expired or the queue was closed
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self.closed, timeout)
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        """Wake up any waiting threads; nothing more can be put in the queue"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class DispatchedCallback(object):
+    """A callback which is run on its own worker thread.
+
+    Calling the object queues the arguments and returns immediately. Created
+    by CallbackDispatcher.wrap().
+    """
+
+    def __init__(self, callback, maxsize=64, overflow="drop_oldest"):
+        self.callback = callback
+        self.queue = EventQueue(maxsize, overflow)
+        self._thread = threading.Thread(
+            target=self._run, name="callback %s" % getattr(callback, "__name__", "")
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, *args):
+        self.queue.put(args)
+
+    @property
+    def queued(self):
+        """Number of calls queued so far"""
+        return self.queue.queued
+
+    @property
+    def dropped(self):
+        """Number of calls discarded by the overflow policy"""
+        return self.queue.dropped
+
+    def _run(self):
+        while True:
+            args = self.queue.get()
+            if args is None:
+                return
+            try:
+                self.callback(*args)
+            except Exception:
+                import traceback
+
+                traceback.print_exc()
+
+    def close(self, timeout=None):
+        """Stop the worker thread, once it has finished any call in progress"""
+        self.queue.close()
+        self._thread.join(timeout)
+
+
+class CallbackDispatcher(object):
+    """Runs callbacks on worker threads instead of the HID reader thread.
+
+    Each wrapped callback gets its own bounded queue and worker thread, so a
+    slow callback neither delays device reads nor the other callbacks. Pass a
+    dispatcher to open() to wrap callback and button_callback.
+
+    Parameters:
+        maxsize:  default number of calls buffered for each callback
+        overflow: default overflow policy, one of OVERFLOW_POLICIES. "conflate"
+                  only keeps the latest state, which suits state callbacks but
+                  loses button presses.
+    """
+
+    def __init__(self, maxsize=64, overflow="drop_oldest"):
+        check_overflow_policy(overflow)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.callbacks = []
+
+    def wrap(self, callback, maxsize=None, overflow=None):
+        """Return a DispatchedCallback which runs callback on a worker thread"""
+        dispatched = DispatchedCallback(
+            callback,
+            self.maxsize if maxsize is None else maxsize,
+            overflow or self.overflow,
+        )
+        self.callbacks.append(dispatched)
+        return dispatched
+
+    def stats(self):
+        """Return a list of {callback, queued, dropped, pending} dicts, one per callback"""
+        return [
+            {
+                "callback": dispatched.callback,
+                "queued": dispatched.queued,
+                "dropped": dispatched.dropped,
+                "pending": len(dispatched.queue),
+            }
+            for dispatched in self.callbacks
+        ]
+
+    def close(self, timeout=None):
+        """Stop all of the worker threads"""
+        for dispatched in self.callbacks:
+            dispatched.close(timeout)
+        self.callbacks = []
+
+
+class StateStream(object):
+    """Asynchronous iterator over the states published by a DeviceSpec.
+
+    States are handed from the reader thread to the event loop with
+    loop.call_soon_threadsafe, and buffered in a bounded queue on the loop.
+    Created by DeviceSpec.stream(), which must be called with the event loop
+    running (or passed explicitly).
+    """
+
+    def __init__(self, device, maxsize=64, overflow="drop_oldest", loop=None):
+        import asyncio
+
+        check_overflow_policy(overflow)
+        self.device = device
+        self.maxsize = max(1, maxsize)
+        self.overflow = overflow
+        # number of states discarded by the overflow policy
+        self.dropped = 0
+        self._loop = loop or asyncio.get_running_loop()
+        self._queue = deque()
+        self._waiter = None
+        self._closed = False
+        # with the block policy, the reader thread takes a slot for each state
+        # and the consumer gives it back once the state has been taken
+        self._slots = threading.Semaphore(self.maxsize) if overflow == "block" else None
+        device.add_listener(self._on_state)
+
+    def _on_state(self, state):
+        # called on the reader thread
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            self._loop.call_soon_threadsafe(self._put, state)
+        except RuntimeError:
+            # the event loop has been closed
+            self.device.remove_listener(self._on_state)
+
+    def _put(self, state):
+        if self._closed:
+            return
+        if self.overflow == "conflate":
+            self.dropped += len(self._queue)
+            self._queue.clear()
+        elif self.overflow == "drop_oldest" and len(self._queue) >= self.maxsize:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append(state)
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = self._loop.create_future()
+            await self._waiter
+        state = self._queue.popleft()
+        if self._slots is not None:
+            self._slots.release()
+        return state
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop receiving states; iteration ends once the queue is empty"""
+        self._closed = True
+        self.device.remove_listener(self._on_state)
+        if self._slots is not None:
+            # unblock the reader thread if it is waiting for a slot
+            self._slots.release()
+        self._loop.call_soon_threadsafe(self._wake)
+
+
+## Input shaping
+# Stages are callables which modify a list of the six axis values
+# [x, y, z, roll, pitch, yaw] in place, given the time t of the state. Stages
+# with parameters take either one value for every axis, or a sequence of six.
+AXIS_COUNT = len(STATE_FIELDS) - 2
+
+
+def _per_axis(value):
+    try:
+        values = [float(v) for v in value]
+    except TypeError:
+        return [float(value)] * AXIS_COUNT
+    if len(values) != AXIS_COUNT:
+        raise ValueError("expected one value per axis, got %d" % len(values))
+    return values
+
+
+class Deadzone(object):
+    """Zero axes whose magnitude is below threshold.
+
+    If rescale is True, the remaining range is stretched back to [-1, 1], so
+    there is no jump at the edge of the dead zone.
+    """
+
+    def __init__(self, threshold=0.05, rescale=True):
+        self.thresholds = _per_axis(threshold)
+        self.rescale = rescale
+
+    def __call__(self, axes, t):
+        for i, threshold in enumerate(self.thresholds):
+            v = axes[i]
+            if -threshold < v < threshold:
+                axes[i] = 0.0
+            elif self.rescale and threshold < 1.0:
+                shifted = v - threshold if v > 0 else v + threshold
+                axes[i] = shifted / (1.0 - threshold)
+
+    def reset(self):
+        pass
+
+
+class Expo(object):
+    """Exponential response curve: (1 - expo) * v + expo * v**3.
+
+    expo=0 is linear; larger values give finer control around the centre.
+    """
+
+    def __init__(self, expo=0.5):
+        self.expos = _per_axis(expo)
+
+    def __call__(self, axes, t):
+        for i, expo in enumerate(self.expos):
+            v = axes[i]
+            axes[i] = (1.0 - expo) * v + expo * v * v * v
+
+    def reset(self):
+        pass
+
+
+class EMA(object):
+    """Exponential moving average with smoothing factor alpha (1 = no smoothing)"""
+
+    def __init__(self, alpha=0.3):
+        self.alphas = _per_axis(alpha)
+        self.reset()
+
+    def __call__(self, axes, t):
+        smoothed = self._smoothed
+        if smoothed is None:
+            self._smoothed = list(axes)
+            return
+        for i, alpha in enumerate(self.alphas):
+            smoothed[i] += alpha * (axes[i] - smoothed[i])
+            axes[i] = smoothed[i]
+
+    def reset(self):
+        self._smoothed = None
+
+
+class OneEuro(object):
+    """The One Euro filter (Casiez et al., CHI 2012): an adaptive low-pass filter
+    which smooths heavily when the input is slow and lightly when it is fast.
+
+    Parameters:
+        min_cutoff: cutoff frequency (Hz) at low speeds; lower removes more jitter
+        beta:       how quickly the cutoff rises with speed; higher reduces lag
+        d_cutoff:   cutoff frequency (Hz) for the speed estimate
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+        self.min_cutoffs = _per_axis(min_cutoff)
+        self.betas = _per_axis(beta)
+        self.d_cutoff = float(d_cutoff)
+        self.reset()
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0 / (2.0 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def __call__(self, axes, t):
+        if self._t is None or t <= self._t:
+            if self._t is None:
+                self._x = list(axes)
+                self._dx = [0.0] * AXIS_COUNT
+                self._t = t
+            else:
+                axes[:] = self._x
+            return
+        dt = t - self._t
+        self._t = t
+        a_d = self._alpha(self.d_cutoff, dt)
+        x, dx = self._x, self._dx
+        for i in range(AXIS_COUNT):
+            dx[i] += a_d * ((axes[i] - x[i]) / dt - dx[i])
+            cutoff = self.min_cutoffs[i] + self.betas[i] * abs(dx[i])
+            x[i] += self._alpha(cutoff, dt) * (axes[i] - x[i])
+            axes[i] = x[i]
+
+    def reset(self):
+        self._t = None
+        self._x = None
+        self._dx = None
+
+
+class DominantAxis(object):
+    """Keep only the axis with the largest magnitude, zeroing the others.
+
+    groups is a sequence of groups of axis indices, and one axis is kept in
+    each group; the default treats all six axes as one group. Use
+    groups=((0, 1, 2), (3, 4, 5)) to keep one translation and one rotation.
+    """
+
+    def __init__(self, groups=(tuple(range(AXIS_COUNT)),)):
+        self.groups = [tuple(group) for group in groups]
+
+    def __call__(self, axes, t):
+        for group in self.groups:
+            dominant = max(group, key=lambda i: abs(axes[i]))
+            for i in group:
+                if i != dominant:
+                    axes[i] = 0.0
+
+    def reset(self):
+        pass
+
+
+class Pipeline(object):
+    """A chain of input shaping stages, applied to the axes of each state in order"""
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self._axes = [0.0] * AXIS_COUNT
+
+    def __call__(self, axes, t):
+        for stage in self.stages:
+            stage(axes, t)
+        return axes
+
+    def apply(self, state):
+        """Shape the axes of a compact state vector in place"""
+        axes = self._axes
+        for i in range(AXIS_COUNT):
+            axes[i] = state[i + 1]
+        for stage in self.stages:
+            stage(axes, state[0])
+        for i in range(AXIS_COUNT):
+            state[i + 1] = axes[i]
+
+    def reset(self):
+        """Reset the state of every stage"""
+        for stage in self.stages:
+            stage.reset()
+
+
+# pose integrated from the axes: position is (x, y, z) and orientation is a
+# unit quaternion (w, x, y, z)
+Pose = namedtuple("Pose", ["t", "position", "orientation"])
+
+
+def quaternion_multiply(a, b):
+    """Hamilton product of two (w, x, y, z) quaternions"""
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return (
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    )
+
+
+def quaternion_rotate(q, v):
+    """Rotate the vector v by the unit quaternion q"""
+    w, x, y, z = quaternion_multiply(
+        quaternion_multiply(q, (0.0, v[0], v[1], v[2])), (q[0], -q[1], -q[2], -q[3])
+    )
+    return (x, y, z)
+
+
+class PoseIntegrator(object):
+    """Integrates the axes, treated as velocities, into a position and orientation.
+
+    Runs on the reader thread for every published state, using the state
+    timestamps for dt, so no motion is lost between reads. Each state's
+    velocities are held until the next state arrives.
+
+    Parameters:
+        translation_gain: units per second at full deflection of x, y, z (one value, or three)
+        rotation_gain:    radians per second at full deflection of pitch, roll, yaw (one value,
+                          or three); these rotate about the x, y and z axes respectively
+        frame:            "world" to move along fixed axes, or "local" to move relative
+                          to the current orientation (like flying a camera)
+        max_dt:           longest interval integrated between two states, so a gap in the
+                          reports can't cause a jump
+    """
+
+    def __init__(self, translation_gain=1.0, rotation_gain=1.0, frame="world", max_dt=0.1):
+        if frame not in ("world", "local"):
+            raise ValueError("frame must be 'world' or 'local', not %r" % frame)
+        self.translation_gains = self._per_vector(translation_gain)
+        self.rotation_gains = self._per_vector(rotation_gain)
+        self.frame = frame
+        self.max_dt = max_dt
+        self._lock = threading.Lock()
+        self.reset()
+
+    @staticmethod
+    def _per_vector(value):
+        try:
+            gains = tuple(float(v) for v in value)
+        except TypeError:
+            return (float(value),) * 3
+        if len(gains) != 3:
+            raise ValueError("expected 3 gains, got %d" % len(gains))
+        return gains
+
+    def reset(self, position=(0.0, 0.0, 0.0), orientation=(1.0, 0.0, 0.0, 0.0)):
+        """Set the pose, and forget the velocity of the last state"""
+        with self._lock:
+            self._t = None
+            self._velocity = None
+            self._position = tuple(float(v) for v in position)
+            self._orientation = tuple(float(v) for v in orientation)
+
+    def pose(self):
+        """Return the current Pose"""
+        with self._lock:
+            return Pose(self._t, self._position, self._orientation)
+
+    def update(self, state):
+        """Integrate up to a new compact state vector"""
+        t = state[0]
+        # x, y, z and the rotations about x (pitch), y (roll) and z (yaw)
+        tg, rg = self.translation_gains, self.rotation_gains
+        velocity = (
+            state[1] * tg[0],
+            state[2] * tg[1],
+            state[3] * tg[2],
+            state[STATE_INDEX["pitch"]] * rg[0],
+            state[STATE_INDEX["roll"]] * rg[1],
+            state[STATE_INDEX["yaw"]] * rg[2],
+        )
+        with self._lock:
+            last_t, last_velocity = self._t, self._velocity
+            self._t, self._velocity = t, velocity
+            if last_t is None or t <= last_t:
+                return
+            dt = min(t - last_t, self.max_dt)
+            q = self._orientation
+
+            vx, vy, vz, wx, wy, wz = last_velocity
+            move = (vx * dt, vy * dt, vz * dt)
+            if self.frame == "local":
+                move = quaternion_rotate(q, move)
+            px, py, pz = self._position
+            self._position = (px + move[0], py + move[1], pz + move[2])
+
+            angle = math.sqrt(wx * wx + wy * wy + wz * wz) * dt
+            if angle > 0.0:
+                k = math.sin(angle / 2.0) / (angle / dt)
+                dq = (math.cos(angle / 2.0), wx * k, wy * k, wz * k)
+                if self.frame == "local":
+                    q = quaternion_multiply(q, dq)
+                else:
+                    q = quaternion_multiply(dq, q)
+                norm = math.sqrt(sum(c * c for c in q))
+                self._orientation = tuple(c / norm for c in q)
+
+
+## Instrumentation
+# latencies are measured with clock_ns, from the arrival time of each report
+
+
+class LatencyHistogram(object):
+    """HDR-style histogram of durations in nanoseconds.
+
+    Values are bucketed by their top sub_bits + 1 significant bits, so any
+    value is recorded with a relative error below 2**-sub_bits, in constant
+    time and memory.
+    """
+
+    def __init__(self, sub_bits=5):
+        self.sub_bits = sub_bits
+        self.counts = [0] * ((65 - sub_bits) << sub_bits)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        """Record one duration"""
+        if ns < 0:
+            ns = 0
+        bits = ns.bit_length()
+        sub_bits = self.sub_bits
+        if bits <= sub_bits:
+            index = ns
+        else:
+            index = ((bits - sub_bits) << sub_bits) + (ns >> (bits - sub_bits - 1)) - (
+                1 << sub_bits
+            )
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def _value(self, index):
+        # lowest value recorded in bucket index
+        sub_bits = self.sub_bits
+        if index < (1 << sub_bits):
+            return index
+        octave = index >> sub_bits
+        return ((index & ((1 << sub_bits) - 1)) + (1 << sub_bits)) << (octave - 1)
+
+    def percentile(self, p):
+        """Return the value below which p percent of the recorded durations fall"""
+        if self.count == 0:
+            return 0
+        target = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def summary(self):
+        """Return {count, mean, p50, p99, max} in nanoseconds"""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class DeviceStats(object):
+    """Counters and latency histograms for one DeviceSpec. See DeviceSpec.enable_stats()."""
+
+    def __init__(self):
+        self.started = clock_ns()
+        self.reports = 0
+        self.published = 0
+        # reports on channels with no mappings
+        self.ignored = 0
+        self.channels = {}
+        # arrival -> decoded (start of publishing), arrival -> all callbacks
+        # returned, and the time spent in the callbacks and listeners
+        self.decode = LatencyHistogram()
+        self.dispatch = LatencyHistogram()
+        self.callback = LatencyHistogram()
+
+    def snapshot(self):
+        """Return the counters and latency summaries as a dictionary"""
+        elapsed = (clock_ns() - self.started) / 1e9
+        return {
+            "elapsed": elapsed,
+            "reports": self.reports,
+            "published": self.published,
+            "ignored": self.ignored,
+            "channels": dict(self.channels),
+            "report_rate": self.reports / elapsed if elapsed > 0 else 0.0,
+            "publish_rate": self.published / elapsed if elapsed > 0 else 0.0,
+            "decode_ns": self.decode.summary(),
+            "dispatch_ns": self.dispatch.summary(),
+            "callback_ns": self.callback.summary(),
+        }
+
+
+class ReportClock(object):
+    """Online estimate of a device's report interval and jitter, from arrival times.
+
+    The interval is an exponentially weighted mean of the time between
+    reports; pauses longer than gap intervals (devices stop reporting at
+    rest) restart the estimate of the phase but keep the interval. Jitter is
+    the mean absolute difference between each arrival and the time it was
+    expected. Until warmup intervals have been seen, a much shorter interval
+    means the earlier ones were pauses and restarts the estimate; after that,
+    short intervals (bunched reports) count as jitter.
+
+    update() also returns a de-jittered timestamp: a local clock which
+    advances by the estimated interval at each report, and is pulled towards
+    the arrival times. A report can't have been sent after it arrived, so an
+    early arrival resets the clock to it.
+    """
+
+    def __init__(self, alpha=0.02, phase_alpha=0.1, gap=4.0, warmup=8):
+        self.alpha = alpha
+        self.phase_alpha = phase_alpha
+        self.gap = gap
+        self.warmup = warmup
+        self.reports = 0
+        # number of intervals in the estimate
+        self._intervals = 0
+        # estimates in ns
+        self.interval = None
+        self.jitter = 0.0
+        self._last = None
+        self._t = None
+
+    def update(self, arrival_ns):
+        """Add a report which arrived at arrival_ns, and return its de-jittered time in ns"""
+        self.reports += 1
+        last, self._last = self._last, arrival_ns
+        interval = self.interval
+        if last is None:
+            self._t = arrival_ns
+            return arrival_ns
+        dt = arrival_ns - last
+        if interval is None or (dt * self.gap < interval and self._intervals < self.warmup):
+            # first interval, or while warming up, the ones so far were really pauses
+            self.interval = float(dt)
+            self._intervals = 1
+            self._t = arrival_ns
+            return arrival_ns
+        if dt > self.gap * interval:
+            # the device paused: restart the phase
+            self._t = arrival_ns
+            return arrival_ns
+        # short intervals after warming up are jitter (e.g. bunched reports)
+        self._intervals += 1
+        # weight the first samples equally, then exponentially
+        alpha = max(self.alpha, 1.0 / self._intervals)
+        self.interval = interval = interval + alpha * (dt - interval)
+        predicted = self._t + interval
+        error = arrival_ns - predicted
+        self.jitter += alpha * (abs(error) - self.jitter)
+        if error < 0:
+            self._t = arrival_ns
+        else:
+            self._t = predicted + self.phase_alpha * error
+        return int(self._t)
+
+    def summary(self):
+        """Return the estimates as a dictionary, in seconds and Hz"""
+        interval = (self.interval or 0.0) / 1e9
+        return {
+            "reports": self.reports,
+            "interval": interval,
+            "rate_hz": 1.0 / interval if interval > 0 else 0.0,
+            "jitter": self.jitter / 1e9,
+        }
+
+
+# how RateLimiter combines the states received between two ticks:
+#   last: the latest state
+#   mean: the mean of each axis
+#   peak: for each axis, the value with the largest magnitude
+AGGREGATES = ("last", "mean", "peak")
+
+
+class RateLimiter(object):
+    """Delivers one conflated state per tick to a callback.
+
+    Between ticks, the reader thread only updates the latest state (and, for
+    the mean and peak aggregates, a running total or peak per axis). Created
+    by DeviceSpec.rate_limit().
+    """
+
+    def __init__(self, device, callback, rate_hz=None, aggregate="last"):
+        if aggregate not in AGGREGATES:
+            raise ValueError(
+                "aggregate must be one of %s, not %r" % (", ".join(AGGREGATES), aggregate)
+            )
+        self.device = device
+        self.callback = callback
+        self.rate_hz = rate_hz
+        self.aggregate = aggregate
+        self._lock = threading.Lock()
+        self._count = 0
+        self._axes = [0.0] * AXIS_COUNT
+        # t of the last state delivered, starting from the current one, so
+        # nothing is delivered until a report arrives
+        self._last_t = device.tuple_state.t
+        if aggregate != "last":
+            device.add_listener(self._on_state, raw=True)
+
+        self._stop = threading.Event()
+        self._thread = None
+        if rate_hz:
+            self._thread = threading.Thread(target=self._run, name="rate limiter")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _on_state(self, state):
+        # called on the reader thread with the compact state vector
+        with self._lock:
+            # tick() replaces the list, so only take it under the lock
+            axes = self._axes
+            self._count += 1
+            if self.aggregate == "mean":
+                for i in range(len(axes)):
+                    axes[i] += state[i + 1]
+            else:
+                for i in range(len(axes)):
+                    if abs(state[i + 1]) > abs(axes[i]):
+                        axes[i] = state[i + 1]
+
+    def tick(self):
+        """Deliver the state for the interval since the last tick
+
+        Returns:
+            the state passed to callback, or None if no reports arrived
+        """
+        if self.aggregate == "last":
+            state = self.device.tuple_state
+            if state.t == self._last_t:
+                return None
+        else:
+            with self._lock:
+                count, axes = self._count, self._axes
+                self._count, self._axes = 0, [0.0] * len(axes)
+            if count == 0:
+                return None
+            if self.aggregate == "mean":
+                axes = [total / count for total in axes]
+            state = self.device.tuple_state
+            state = SpaceNavigator(state.t, *axes, buttons=state.buttons)
+        self._last_t = state.t
+        if self.callback:
+            self.callback(state)
+        return state
+
+    def _run(self):
+        interval = 1.0 / self.rate_hz
+        deadline = high_acc_clock()
+        while True:
+            deadline += interval
+            now = high_acc_clock()
+            if deadline < now:
+                # fell behind (e.g. a slow callback): skip the missed ticks
+                deadline = now
+            if self._stop.wait(deadline - now):
+                return
+            self.tick()
+
+    def close(self):
+        """Stop delivering states"""
+        self._stop.set()
+        self.device.remove_listener(self._on_state)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+## Shared memory publication
+# A shared memory block holds a header, a seqlock sequence number, the latest
+# state and an optional ring of recent states. States are stored as the compact
+# state vector: the SpaceNavigator fields as doubles, buttons as a bitmask.
+#
+# header: magic, layout version, number of fields, number of buttons, ring capacity
+# The sequence number is odd while the publisher is writing and is incremented
+# by 2 for each state, so seq // 2 states have been published.
+
+SHM_MAGIC = b"SNSM"
+SHM_VERSION = 1
+SHM_HEADER = struct.Struct("<4sHHII")
+SHM_SEQ = struct.Struct("<Q")
+SHM_STATE = struct.Struct("<%dd" % len(STATE_FIELDS))
+SHM_SEQ_OFFSET = 16
+SHM_STATE_OFFSET = SHM_SEQ_OFFSET + SHM_SEQ.size
+SHM_RING_OFFSET = SHM_STATE_OFFSET + SHM_STATE.size
+
+
+def _attach_shared_memory(name):
+    """Attach to an existing shared memory block without taking ownership of it"""
+    from multiprocessing import shared_memory
+
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before Python 3.13, attaching registers the block with the resource
+    # tracker, which would unlink it when this process exits
+    from multiprocessing import resource_tracker
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedStatePublisher(object):
+    """Writes each published state of a device into a shared memory block.
+
+    Any number of processes can read the block with SharedStateReader. The
+    writer brackets each update with a seqlock, so readers never see a torn
+    state and the writer never waits for them. Created by DeviceSpec.share().
+    """
+
+    def __init__(self, device, name=None, history=0):
+        from multiprocessing import shared_memory
+
+        self.device = device
+        self.capacity = history or 0
+        size = SHM_RING_OFFSET + self.capacity * SHM_STATE.size
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.shm.name
+        self._buf = self.shm.buf
+        self._seq = 0
+        SHM_HEADER.pack_into(
+            self._buf,
+            0,
+            SHM_MAGIC,
+            SHM_VERSION,
+            len(STATE_FIELDS),
+            len(device.button_mapping),
+            self.capacity,
+        )
+        SHM_SEQ.pack_into(self._buf, SHM_SEQ_OFFSET, 0)
+        SHM_STATE.pack_into(self._buf, SHM_STATE_OFFSET, *device.snapshot())
+        device.add_listener(self._on_state, raw=True)
+
+    def _on_state(self, state):
+        # called on the reader thread with the compact state vector
+        buf, seq = self._buf, self._seq
+        SHM_SEQ.pack_into(buf, SHM_SEQ_OFFSET, seq + 1)
+        SHM_STATE.pack_into(buf, SHM_STATE_OFFSET, *state)
+        if self.capacity:
+            slot = (seq // 2) % self.capacity
+            SHM_STATE.pack_into(buf, SHM_RING_OFFSET + slot * SHM_STATE.size, *state)
+        self._seq = seq + 2
+        SHM_SEQ.pack_into(buf, SHM_SEQ_OFFSET, seq + 2)
+
+    def close(self):
+        """Stop publishing, and remove the shared memory block"""
+        self.device.remove_listener(self._on_state)
+        if self.shm is not None:
+            self._buf = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SharedStateReader(object):
+    """Reads the states written by a SharedStatePublisher, from any process.
+
+    Reads are lock-free: each one unpacks the state straight from shared
+    memory, and retries if the publisher wrote it in the meantime. If the
+    publisher stays mid-update for timeout seconds (e.g. its process died while
+    writing), reads raise TimeoutError instead of waiting forever.
+    """
+
+    def __init__(self, name, timeout=1.0):
+        self.shm = _attach_shared_memory(name)
+        self.name = name
+        self.timeout = timeout
+        self._buf = self.shm.buf
+        magic, version, fields, self.n_buttons, self.capacity = SHM_HEADER.unpack_from(
+            self._buf, 0
+        )
+        if magic != SHM_MAGIC or version != SHM_VERSION or fields != len(STATE_FIELDS):
+            self.close()
+            raise ValueError("%s is not a spacenavigator shared state block" % name)
+
+    @property
+    def seq(self):
+        """The number of states published so far"""
+        return SHM_SEQ.unpack_from(self._buf, SHM_SEQ_OFFSET)[0] // 2
+
+    def _settled_seq(self):
+        """Return the raw (even) sequence number once no update is in progress"""
+        seq = SHM_SEQ.unpack_from(self._buf, SHM_SEQ_OFFSET)[0]
+        if not seq & 1:
+            return seq
+        deadline = high_acc_clock() + self.timeout
+        retries = 0
+        while True:
+            # an update takes microseconds: yield to the publisher, then back off
+            retries += 1
+            sleep(0 if retries < 100 else 0.001)
+            seq = SHM_SEQ.unpack_from(self._buf, SHM_SEQ_OFFSET)[0]
+            if not seq & 1:
+                return seq
+            if high_acc_clock() > deadline:
+                raise TimeoutError(
+                    "%s has been mid-update for %gs; its publisher may have died"
+                    % (self.name, self.timeout)
+                )
+
+    def snapshot(self):
+        """Return (seq, state) for the latest state
+
+        Returns:
+            seq:   the number of states published so far
+            state: compact (t, x, y, z, roll, pitch, yaw, buttons) tuple, as
+                   returned by DeviceSpec.snapshot()
+        """
+        buf = self._buf
+        while True:
+            before = self._settled_seq()
+            state = SHM_STATE.unpack_from(buf, SHM_STATE_OFFSET)
+            if SHM_SEQ.unpack_from(buf, SHM_SEQ_OFFSET)[0] == before:
+                return before // 2, state
+
+    def read(self):
+        """Return the latest state as a SpaceNavigator namedtuple"""
+        seq, state = self.snapshot()
+        return SpaceNavigator(*state[:-1], button_state(int(state[-1]), self.n_buttons))
+
+    def history(self, n=None):
+        """Return up to n of the most recent states in the ring, oldest first
+
+        Returns:
+            list of compact state tuples; empty if the publisher keeps no history
+        """
+        buf, capacity = self._buf, self.capacity
+        while True:
+            before = self._settled_seq()
+            count = min(before // 2, capacity)
+            if n is not None:
+                count = min(count, n)
+            first = before // 2 - count
+            states = [
+                SHM_STATE.unpack_from(
+                    buf, SHM_RING_OFFSET + ((first + i) % capacity) * SHM_STATE.size
+                )
+                for i in range(count)
+            ]
+            if SHM_SEQ.unpack_from(buf, SHM_SEQ_OFFSET)[0] == before:
+                return states
+
+    def close(self):
+        """Detach from the shared memory block (it is left for the publisher to remove)"""
+        if self.shm is not None:
+            self._buf = None
+            self.shm.close()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+## Network streaming
+# A UDP datagram is a header followed by count fixed-size frames:
+#
+# header: magic, format version, frame count, number of buttons, epoch, axis_scale
+# frame:  sequence number, timestamp (integer ns, sender's high_acc_clock),
+#         x, y, z, roll, pitch, yaw quantized to int16 (value * axis_scale),
+#         button bitmask
+#
+# Frames are numbered consecutively, so receivers can detect lost and
+# reordered frames; sequence numbers wrap at 2**32. Each publisher picks a
+# random epoch, so receivers can tell when a publisher has been restarted
+# and its numbering starts again.
+
+NET_MAGIC = b"SN"
+NET_VERSION = 2
+NET_HEADER = struct.Struct("<2sBBBxIf")
+NET_FRAME = struct.Struct("<Iq6hI")
+# frames per datagram, keeping datagrams well under a typical MTU
+NET_MAX_BATCH = 32
+
+
+def _quantize(value, axis_scale):
+    return max(-32768, min(32767, int(round(value * axis_scale))))
+
+
+class UDPPublisher(object):
+    """Sends each published state of a device over UDP, as compact binary frames.
+
+    With batch > 1, up to batch frames are sent per datagram; a partly filled
+    batch is sent after max_delay seconds. Created by DeviceSpec.publish_udp().
+    """
+
+    def __init__(self, device, address, batch=1, max_delay=0.005):
+        import socket
+
+        if not 1 <= batch <= NET_MAX_BATCH:
+            raise ValueError("batch must be between 1 and %d" % NET_MAX_BATCH)
+        self.device = device
+        self.address = address
+        self.batch = batch
+        self.max_delay = max_delay
+        self.sent = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.epoch = int.from_bytes(os.urandom(4), "little")
+        self._header = (len(device.button_mapping), self.epoch, device.axis_scale)
+        self._seq = 0
+        self._frames = []
+        # high_acc_clock time the oldest buffered frame was added
+        self._first = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if batch > 1:
+            self._thread = threading.Thread(target=self._run, name="udp publisher")
+            self._thread.daemon = True
+            self._thread.start()
+        device.add_listener(self._on_state, raw=True)
+
+    def _on_state(self, state):
+        # called on the reader thread with the compact state vector
+        scale = self.device.axis_scale
+        frame = NET_FRAME.pack(
+            self._seq,
+            int(state[0] * 1e9),
+            _quantize(state[1], scale),
+            _quantize(state[2], scale),
+            _quantize(state[3], scale),
+            _quantize(state[4], scale),
+            _quantize(state[5], scale),
+            _quantize(state[6], scale),
+            int(state[-1]) & 0xFFFFFFFF,
+        )
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        with self._lock:
+            if not self._frames:
+                self._first = high_acc_clock()
+            self._frames.append(frame)
+            if len(self._frames) >= self.batch:
+                self._send()
+
+    def _send(self):
+        # called with the lock held
+        frames, self._frames = self._frames, []
+        if not frames:
+            return
+        n_buttons, epoch, axis_scale = self._header
+        header = NET_HEADER.pack(
+            NET_MAGIC, NET_VERSION, len(frames), n_buttons, epoch, axis_scale
+        )
+        try:
+            self._socket.sendto(header + b"".join(frames), self.address)
+            self.sent += len(frames)
+        except OSError:
+            # nobody listening (or the network is down); UDP is best effort
+            pass
+
+    def _run(self):
+        while not self._stop.wait(self.max_delay):
+            with self._lock:
+                if self._frames and high_acc_clock() - self._first >= self.max_delay:
+                    self._send()
+
+    def flush(self):
+        """Send any buffered frames now"""
+        with self._lock:
+            self._send()
+
+    def close(self):
+        """Stop sending states, after sending any buffered frames"""
+        self.device.remove_listener(self._on_state)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UDPSubscriber(object):
+    """Receives states sent by a UDPPublisher.
+
+    Only the newest state is kept: frames older than the latest one received
+    (reordered or duplicated in the network) are discarded, and gaps in the
+    sequence numbers are counted as lost frames. If the publisher restarts
+    (its epoch changes), the numbering starts again from its first frame.
+
+    Parameters:
+        address:  (host, port) to listen on
+        callback: if given, called on the receiving thread with each newer state
+                  (the newest frame of each datagram)
+    """
+
+    def __init__(self, address, callback=None):
+        import socket
+
+        self.callback = callback
+        self.received = 0
+        self.lost = 0
+        self.stale = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(address)
+        self._socket.settimeout(0.1)
+        self.address = self._socket.getsockname()
+        self._epoch = None
+        self._last_seq = None
+        self._state = None
+        self._lock = threading.Lock()
+        self._new_state = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="udp subscriber")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                data = self._socket.recv(65536)
+            except OSError:
+                # timeout, or the socket was closed
+                continue
+            state = self.process(data)
+            if state is not None and self.callback:
+                self.callback(state)
+
+    def process(self, data):
+        """Decode one datagram and update the latest state
+
+        Returns:
+            the new latest state, or None if the datagram held nothing newer
+        """
+        if len(data) < NET_HEADER.size:
+            return None
+        magic, version, count, n_buttons, epoch, axis_scale = NET_HEADER.unpack_from(data, 0)
+        if magic != NET_MAGIC or version != NET_VERSION:
+            return None
+        if len(data) < NET_HEADER.size + count * NET_FRAME.size:
+            return None
+        newest = None
+        with self._lock:
+            if epoch != self._epoch:
+                # a new publisher: don't compare its numbers with the old one's
+                self._epoch = epoch
+                self._last_seq = None
+            for i in range(count):
+                frame = NET_FRAME.unpack_from(data, NET_HEADER.size + i * NET_FRAME.size)
+                seq = frame[0]
+                self.received += 1
+                if self._last_seq is not None:
+                    ahead = (seq - self._last_seq) & 0xFFFFFFFF
+                    if ahead == 0 or ahead >= 0x80000000:
+                        self.stale += 1
+                        continue
+                    self.lost += ahead - 1
+                self._last_seq = seq
+                newest = frame
+            if newest is None:
+                return None
+            self._state = SpaceNavigator(
+                newest[1] / 1e9,
+                *[value / axis_scale for value in newest[2:8]],
+                button_state(newest[-1], n_buttons)
+            )
+            self._new_state.notify_all()
+            return self._state
+
+    @property
+    def seq(self):
+        """Sequence number of the latest frame received, or None"""
+        return self._last_seq
+
+    def read(self, timeout=None):
+        """Return the latest state received
+
+        If no state has been received yet, waits up to timeout seconds
+        (forever if None) and returns None if none arrives.
+        """
+        with self._lock:
+            if self._state is None:
+                self._new_state.wait(timeout)
+            return self._state
+
+    def stats(self):
+        """Return a dictionary with the numbers of frames received, lost and stale"""
+        return {"received": self.received, "lost": self.lost, "stale": self.stale}
+
+    def close(self):
+        """Stop receiving"""
+        self._stop.set()
+        self._thread.join()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _FrameDeadlines(object):
+    """Publishes partial frames whose other half doesn't arrive in time.
+
+    One thread serves every device: each device with a partial frame arms its
+    deadline, and the thread calls its _expire_frame() once the deadline passes.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        # device -> deadline on the high_acc_clock
+        self._deadlines = {}
+        # the deadline the thread is waiting for, or None if it is waiting for any
+        self._next = None
+        self._thread = None
+
+    def arm(self, device, deadline):
+        with self._cond:
+            self._deadlines[device] = deadline
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="frame deadlines")
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._next is None or deadline < self._next:
+                # devices can have different timeouts, so this may be due first
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._deadlines:
+                        self._next = None
+                        self._cond.wait()
+                        continue
+                    device = min(self._deadlines, key=self._deadlines.get)
+                    self._next = self._deadlines[device]
+                    wait = self._next - high_acc_clock()
+                    if wait <= 0:
+                        del self._deadlines[device]
+                        break
+                    self._cond.wait(wait)
+            try:
+                device._expire_frame()
+            except Exception:
+                import traceback
+
+                traceback.print_exc()
+
+
+_frame_deadlines = _FrameDeadlines()
+
+
+class DeviceSpec(object):
+    """Holds the specification of a single 3Dconnexion device"""
+
+    def __init__(
+        self, name, hid_id, led_id, mappings, button_mapping, axis_scale=350.0
+    ):
+        self.name = name
+        self.hid_id = hid_id
+        self.led_id = led_id
+        self.mappings = mappings
+        self.button_mapping = button_mapping
+        self.axis_scale = axis_scale
+        self._compile()
+
+        # optional Pipeline applied to the axes of each published state
+        self.pipeline = None
+
+        # publish split 6DOF states only once all channels have been received
+        self.coalesce_frames = False
+        self.frame_timeout = 0.02
+        # held while processing a report if coalescing, as a partial frame can
+        # also be published from the frame deadline thread
+        self._frame_lock = threading.Lock()
+
+        # full 32 bit HID usage ID (page << 16 | usage) of the LED
+        self.led_usage = (led_id[0] << 16) | led_id[1]
+        self._init_state()
+
+        # start in disconnected state
+        self.device = None
+        self.callback = None
+        self.button_callback = None
+        self._history = None
+        self._recorder = None
+        # RateLimiter created by open(max_rate_hz=...)
+        self.rate_limiter = None
+        # PoseIntegrator created by enable_pose()
+        self.integrator = None
+        # DeviceStats, if enabled, and the arrival time of the report being processed
+        self._stats = None
+        self._stats_export = None
+        self._arrival_ns = 0
+        # channel -> ReportClock, if timing is enabled; if dejitter is set,
+        # published states are stamped with the de-jittered times
+        self._clocks = None
+        self._clock_alpha = 0.02
+        self.dejitter = False
+        # HotplugMonitor which reattaches this device, and connection_callback(dev, connected)
+        # which it calls when the device is detached or reattached
+        self.hotplug = None
+        self.connection_callback = None
+        # path and serial number of the last HID device attached
+        self.hid_path = None
+        self.hid_serial = None
+        # OutputQueue writing output reports to the attached device, and the
+        # raw LED output reports for off and on, resolved when the device is opened
+        self._output = None
+        self._led_reports = None
+        # functions called with the state namedtuple each time it is published,
+        # and functions called with the compact state vector
+        self._listeners = ()
+        self._raw_listeners = ()
+        # button index (or None for any button) -> handlers called with each
+        # ButtonEvent, and (mask, handler) pairs for chords
+        self._button_routes = {}
+        self._chords = ()
+        # notified when a state is published, if anyone is blocked in wait()
+        self._published = threading.Condition(threading.Lock())
+        self._waiters = 0
+
+    def __getstate__(self):
+        # compiled structs can't be copied; rebuild them in __setstate__
+        state = self.__dict__.copy()
+        del state["_decoders"]
+        # runtime buffers are per-device and are not copied
+        state["_history"] = None
+        state["_recorder"] = None
+        state["_stats"] = None
+        state["_stats_export"] = None
+        state["_listeners"] = ()
+        state["_raw_listeners"] = ()
+        state["_button_routes"] = {}
+        state["_chords"] = ()
+        state["_clocks"] = None if self._clocks is None else {}
+        state["_output"] = None
+        del state["_published"]
+        del state["_frame_lock"]
+        state["_waiters"] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._published = threading.Condition(threading.Lock())
+        self._frame_lock = threading.Lock()
+        self._compile()
+
+    def _compile(self):
+        self._decoders = compile_decoders(
+            self.mappings, self.button_mapping, self.axis_scale
+        )
+        # devices which split the axes across several channels get one bit per
+        # channel; a frame is complete once all of the bits have been received
+        axis_channels = sorted(set(axis.channel for axis in self.mappings.values()))
+        if len(axis_channels) > 1:
+            self._frame_bits = {chan: 1 << i for i, chan in enumerate(axis_channels)}
+        else:
+            self._frame_bits = {}
+        self._frame_complete = (1 << len(self._frame_bits)) - 1
+
+    def _init_state(self):
+        """Initialise the double-buffered state vectors to t=-1 and 0s elsewhere.
+
+        The reader thread writes each report into the back buffer and then
+        swaps it to the front, so no objects are allocated per report.
+        Readers only ever copy the front buffer.
+        """
+        self._front = array("d", [-1.0] + [0.0] * (len(STATE_FIELDS) - 1))
+        self._back = array("d", self._front)
+        # the decoded state before the pipeline is applied
+        self._raw = array("d", self._front)
+        # holds a partial frame while a button change is published
+        self._partial = array("d", self._front)
+        # bitmask of the frame_bits received into the back buffer but not yet published
+        self._pending = 0
+        self._frame_start = 0.0
+        # high_acc_clock time at which a partial frame is published on its own
+        self._frame_deadline = 0.0
+        # number of states published; incremented as each one is swapped to the front
+        self._seq = 0
+        # seqlock around the swap: odd while the front buffer and _seq are changing
+        self._version = 0
+        # (snapshot, namedtuple) pair of the last view handed out by read()
+        self._view = (None, None)
+
+    def _make_view(self, snapshot):
+        """Build a SpaceNavigator namedtuple from a compact state snapshot"""
+        buttons = button_state(int(snapshot[-1]), len(self.button_mapping))
+        return SpaceNavigator(*snapshot[:-1], buttons)
+
+    @property
+    def tuple_state(self):
+        """The current state as a SpaceNavigator namedtuple.
+
+        The namedtuple is built on demand and cached until the state changes.
+        """
+        return self._view_of(self.snapshot())
+
+    def _view_of(self, snapshot):
+        """Return the namedtuple for a snapshot, reusing the last one if it is unchanged"""
+        cached, view = self._view
+        if cached != snapshot:
+            view = self._make_view(snapshot)
+            self._view = (snapshot, view)
+        return view
+
+    def snapshot(self):
+        """Return an immutable copy of the compact current state.
+
+        Returns: (t, x, y, z, roll, pitch, yaw, buttons) tuple, where buttons is
+            an integer bitmask with bit i set if button i is pressed.
+        """
+        return self.snapshot_seq()[1]
+
+    def snapshot_seq(self):
+        """Return (seq, snapshot): the sequence number and a copy of the current state
+
+        The swap to the front and the increment of seq are bracketed by a
+        seqlock. The reader thread only writes into the buffer which is not at
+        the front, and a buffer only goes back to being written after another
+        state has been published, so a copy taken while the lock's version is
+        unchanged (and even) is neither torn nor paired with the wrong seq.
+        """
+        while True:
+            version = self._version
+            if version & 1:
+                # the reader thread is part way through a swap: let it finish
+                sleep(0)
+                continue
+            seq = self._seq
+            snapshot = tuple(self._front)
+            if self._version == version:
+                return seq, snapshot
+
+    @property
+    def seq(self):
+        """The number of states published so far; each state's sequence number"""
+        return self._seq
+
+    def wait(self, after_seq=None, timeout=None):
+        """Block until a state newer than after_seq has been published
+
+        Parameters:
+            after_seq: sequence number of the last state the caller has seen. If
+                       None, waits for the next state to be published.
+            timeout:   longest time to wait in seconds, or None to wait forever
+
+        Returns:
+            (state, seq, missed): the latest state namedtuple, its sequence number
+            and the number of states published after after_seq and before it.
+            None if timeout expired first.
+        """
+        with self._published:
+            if after_seq is None:
+                after_seq = self._seq
+            self._waiters += 1
+            try:
+                if not self._published.wait_for(lambda: self._seq > after_seq, timeout):
+                    return None
+            finally:
+                self._waiters -= 1
+        seq, snapshot = self.snapshot_seq()
+        return self._view_of(snapshot), seq, seq - after_seq - 1
+
+    def describe_connection(self):
+        """Return string representation of the device, including
+        the connection state"""
+        if self.device == None:
+            return "%s [disconnected]" % (self.name)
+        else:
+            return "%s connected to %s %s version: %s [serial: %s]" % (
+                self.name,
+                self.vendor_name,
+                self.product_name,
+                self.version_number,
+                self.serial_number,
+            )
+
+    @property
+    def connected(self):
+        """True if the device has been connected"""
+        return self.device is not None
+
+    @property
+    def state(self):
+        """Return the current value of read()
+
+        Returns: state: {t,x,y,z,pitch,yaw,roll,button} namedtuple
+                None if the device is not open.
+        """
+        return self.read()
+
+    def open(self):
+        """Open a connection to the device, if possible"""
+        if self.device:
+            self.device.open()
+        # copy in product details
+        self.product_name = self.device.product_name
+        self.vendor_name = self.device.vendor_name
+        self.version_number = self.device.version_number
+        # doesn't seem to work on 3dconnexion devices...
+        # serial number will be a byte string, we convert to a hex id
+        self.serial_number = hex_serial(self.device.serial_number)
+        # look up the LED output report once, rather than on every set_led()
+        led_report = getattr(self.device, "led_report", None)
+        self._led_reports = None
+        if led_report is not None:
+            reports = (led_report(self.led_usage, False), led_report(self.led_usage, True))
+            if None not in reports:
+                self._led_reports = tuple(bytes(report) for report in reports)
+        if self._output is not None:
+            self._output.close()
+        self._output = OutputQueue(self.device)
+
+    def attach(self, device):
+        """Connect to a transport device, open it and start processing its reports"""
+        self.device = device
+        self.hid_path = device.path
+        self.hid_serial = device.serial_number
+        self.open()
+        device.set_raw_data_handler(self._on_report)
+
+    def _on_report(self, data, arrival_ns=None):
+        # the handler given to the transport, which passes the arrival time
+        self.process(data, None, arrival_ns)
+
+    def detach(self):
+        """Release the transport device after it has been removed.
+
+        Unlike close(), callbacks, history and the rest of the state are kept,
+        so the device can be reattached with attach().
+        """
+        device, self.device = self.device, None
+        if self._output is not None:
+            # the device is gone, so anything still queued is dropped
+            self._output.close(flush=False)
+            self._output = None
+        if device is not None:
+            _release_device(device)
+            try:
+                device.close()
+            except Exception:
+                # the device may already be gone
+                pass
+
+    def set_led(self, state):
+        """Set the LED state to state (True or False)
+
+        The write is queued (see send_output_report()), so this is safe to
+        call from callbacks on the reader thread.
+        """
+        if self.connected and self._led_reports is not None:
+            self.send_output_report(self._led_reports[bool(state)])
+
+    def send_output_report(self, data):
+        """Queue a raw output report (starting with its report ID) to be written
+
+        Reports are written in order from a background thread, so this never
+        blocks. A report replaces one with the same report ID which is still
+        queued, and a report identical to the last one written for that ID is
+        skipped.
+        """
+        if self.connected and self._output is not None:
+            self._output.put(data)
+
+    def flush_output(self, timeout=None):
+        """Wait until the queued output reports have been written
+
+        Returns:
+            True if the queue is empty, False if timeout expired first
+        """
+        if self._output is None:
+            return True
+        return self._output.flush(timeout)
+
+    def close(self):
+        """Close the connection, if it is open"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.close()
+            self.rate_limiter = None
+        if self.hotplug is not None:
+            self.hotplug.remove(self)
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+        if self.connected:
+            _release_device(self.device)
+            self.device.close()
+            self.device = None
+
+    def read(self):
+        """Return the current state of this navigation controller.
+
+        Returns:
+            state: {t,x,y,z,pitch,yaw,roll,button} namedtuple
+            None if the device is not open.
+        """
+        if self.connected:
+            return self.tuple_state
+        else:
+            return None
+
+    def add_listener(self, listener, raw=False):
+        """Call listener(state) on the reader thread each time a state is published
+
+        If raw is True, state is the compact state vector (as returned by
+        snapshot()) rather than a namedtuple. The vector is reused, so it is only
+        valid during the call; raw listeners avoid building a namedtuple for
+        every report.
+        """
+        # the tuples are replaced rather than mutated, so the reader thread can
+        # iterate over them without locking
+        if raw:
+            self._raw_listeners = self._raw_listeners + (listener,)
+        else:
+            self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        """Remove a listener added with add_listener(), if it is present"""
+        self._listeners = tuple(l for l in self._listeners if l != listener)
+        self._raw_listeners = tuple(l for l in self._raw_listeners if l != listener)
+
+    def on_button(self, button, handler):
+        """Call handler(event) on the reader thread when a button is pressed or released
+
+        Only the handlers for buttons which changed are called.
+
+        Parameters:
+            button:  index of the button (as in state.buttons), or None for every button
+            handler: called with a ButtonEvent(t, button, pressed, mask) for each edge
+        """
+        routes = dict(self._button_routes)
+        routes[button] = routes.get(button, ()) + (handler,)
+        self._button_routes = routes
+
+    def on_chord(self, buttons, handler):
+        """Call handler(event) when all of buttons are held together
+
+        The handler is called once, with the ButtonEvent of the press which
+        completed the chord; the chord must be released before it fires again.
+
+        Parameters:
+            buttons: sequence of button indices
+        """
+        mask = 0
+        for button in buttons:
+            mask |= 1 << button
+        self._chords = self._chords + ((mask, handler),)
+
+    def remove_button_handler(self, handler):
+        """Remove a handler added with on_button() or on_chord(), if it is present"""
+        routes = {}
+        for button, handlers in self._button_routes.items():
+            handlers = tuple(h for h in handlers if h != handler)
+            if handlers:
+                routes[button] = handlers
+        self._button_routes = routes
+        self._chords = tuple(chord for chord in self._chords if chord[1] != handler)
+
+    def rate_limit(self, callback, rate_hz=None, aggregate="last"):
+        """Deliver at most one state per tick to callback, instead of one per report
+
+        Parameters:
+            callback:  called with the state namedtuple at each tick, if any
+                       reports arrived since the last one
+            rate_hz:   ticks per second, driven by a background thread. If None,
+                       call tick() on the returned object (e.g. once per frame).
+            aggregate: how the states between ticks are combined; one of
+                       AGGREGATES
+
+        Returns:
+            the RateLimiter. Close it to stop delivery.
+        """
+        return RateLimiter(self, callback, rate_hz, aggregate)
+
+    def stream(self, maxsize=64, overflow="drop_oldest", loop=None):
+        """Return an asynchronous iterator over the published states
+
+        Usage:
+            async for state in dev.stream():
+                ...
+
+        Parameters:
+            maxsize:  number of states buffered for a slow consumer
+            overflow: what to do when the buffer is full; one of OVERFLOW_POLICIES
+            loop:     event loop to deliver states on. Defaults to the running loop.
+
+        Returns:
+            a StateStream. Close it (or use it as an async context manager) to
+            stop receiving states.
+        """
+        return StateStream(self, maxsize, overflow, loop)
+
+    def share(self, name=None, history=0):
+        """Publish every state into a shared memory block, for other processes
+
+        Parameters:
+            name:    name of the block; a unique name is chosen if None
+            history: number of recent states kept in a ring in the block
+
+        Returns:
+            the SharedStatePublisher. Open a SharedStateReader on its name in
+            another process to read the states; close the publisher to remove
+            the block.
+        """
+        return SharedStatePublisher(self, name, history)
+
+    def publish_udp(self, address, batch=1, max_delay=0.005):
+        """Send every state over UDP, as compact binary frames
+
+        Parameters:
+            address:   (host, port) to send to; receive with UDPSubscriber
+            batch:     number of frames per datagram, up to NET_MAX_BATCH
+            max_delay: longest time (in seconds) a frame waits for its batch to fill
+
+        Returns:
+            the UDPPublisher. Close it to stop sending.
+        """
+        return UDPPublisher(self, address, batch, max_delay)
+
+    async def next_state(self, timeout=None):
+        """Wait for the next published state and return it
+
+        Raises asyncio.TimeoutError if timeout (in seconds) expires first.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
 
-# axis mappings are specified as:
-# [channel, byte1, byte2, scale]; scale is usually just -1 or 1 and multiplies the result by this value
-# (but per-axis scaling can also be achieved by setting this value)
-# byte1 and byte2 are indices into the HID array indicating the two bytes to read to form the value for this axis
-# For the SpaceNavigator, these are consecutive bytes following the channel number.
-AxisSpec = namedtuple("AxisSpec", ["channel", "byte1", "byte2", "scale"])
+        def resolve(state):
+            if not future.done():
+                future.set_result(state)
 
+        def on_state(state):
+            self.remove_listener(on_state)
+            loop.call_soon_threadsafe(resolve, state)
 
-# button states are specified as:
-# [channel, data byte,  bit of byte, index to write to]
-# If a message is received on the specified channel, the value of the data byte is set in the button bit array
-ButtonSpec = namedtuple("ButtonSpec", ["channel", "byte", "bit"])
+        self.add_listener(on_state)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.remove_listener(on_state)
 
+    def set_pipeline(self, *stages):
+        """Shape the axes of every published state with the given stages
 
-## Simple HID code to read data from the 3dconnexion devices
+        For example:
+            dev.set_pipeline(Deadzone(0.1), Expo(0.4), OneEuro(min_cutoff=1.0, beta=0.5))
 
-# convert two 8 bit bytes to a signed 16 bit integer
-def to_int16(y1, y2):
-    x = (y1) | (y2 << 8)
-    if x >= 32768:
-        x = -(65536 - x)
-    return x
+        The stages run once per published state (once per frame with
+        coalesce_frames), on the reader thread. Call with no stages to remove
+        the pipeline.
 
+        Returns:
+            the Pipeline, or None
+        """
+        if self.pipeline is None:
+            # values are carried forward from the unshaped state once there is
+            # a pipeline, so start it from the current state
+            self._raw[:] = self._front
+        self.pipeline = Pipeline(stages) if stages else None
+        return self.pipeline
 
-# tuple for 6DOF results
-SpaceNavigator = namedtuple(
-    "SpaceNavigator", ["t", "x", "y", "z", "roll", "pitch", "yaw", "buttons"]
-)
+    def enable_pose(self, translation_gain=1.0, rotation_gain=1.0, frame="world"):
+        """Integrate every published state into a pose (see PoseIntegrator)
 
+        Returns:
+            the PoseIntegrator
+        """
+        if self.integrator is not None:
+            self.remove_listener(self.integrator.update)
+        self.integrator = PoseIntegrator(translation_gain, rotation_gain, frame)
+        self.add_listener(self.integrator.update, raw=True)
+        return self.integrator
 
-class ButtonState(list):
-    def __int__(self):
-        return sum((b << i) for (i, b) in enumerate(reversed(self)))
+    def pose(self):
+        """Return the current Pose(t, position, orientation), or None if enable_pose() has not been called"""
+        if self.integrator is not None:
+            return self.integrator.pose()
 
+    def reset_pose(self, position=(0.0, 0.0, 0.0), orientation=(1.0, 0.0, 0.0, 0.0)):
+        """Reset the integrated pose to the given position and (w, x, y, z) orientation"""
+        if self.integrator is not None:
+            self.integrator.reset(position, orientation)
 
-class DeviceSpec(object):
-    """Holds the specification of a single 3Dconnexion device"""
+    def enable_stats(self, enabled=True, export=None, interval=1.0):
+        """Start (or stop) collecting latency and throughput statistics
 
-    def __init__(
-        self, name, hid_id, led_id, mappings, button_mapping, axis_scale=350.0
-    ):
-        self.name = name
-        self.hid_id = hid_id
-        self.led_id = led_id
-        self.mappings = mappings
-        self.button_mapping = button_mapping
-        self.axis_scale = axis_scale
+        Parameters:
+            enabled:  if False, stop collecting statistics
+            export:   if given, export(stats) is called every interval seconds from a
+                      background thread, with the statistics for that interval
+        """
+        if self._stats_export is not None:
+            self._stats_export.set()
+            self._stats_export = None
+        self._stats = DeviceStats() if enabled else None
+        if enabled and export is not None:
+            stop = threading.Event()
 
-        self.led_usage = hid.get_full_usage_id(led_id[0], led_id[1])
-        # initialise to a vector of 0s for each state
-        self.dict_state = {
-            "t": -1,
-            "x": 0,
-            "y": 0,
-            "z": 0,
-            "roll": 0,
-            "pitch": 0,
-            "yaw": 0,
-            "buttons": ButtonState([0] * len(self.button_mapping)),
-        }
-        self.tuple_state = SpaceNavigator(**self.dict_state)
+            def run():
+                while not stop.wait(interval):
+                    export(self.stats(reset=True))
 
-        # start in disconnected state
-        self.device = None
-        self.callback = None
-        self.button_callback = None
+            thread = threading.Thread(target=run, name="stats export")
+            thread.daemon = True
+            thread.start()
+            self._stats_export = stop
 
-    def describe_connection(self):
-        """Return string representation of the device, including
-        the connection state"""
-        if self.device == None:
-            return "%s [disconnected]" % (self.name)
-        else:
-            return "%s connected to %s %s version: %s [serial: %s]" % (
-                self.name,
-                self.vendor_name,
-                self.product_name,
-                self.version_number,
-                self.serial_number,
-            )
+    def stats(self, reset=False):
+        """Return a snapshot of the statistics, or None if they are not enabled
 
-    @property
-    def connected(self):
-        """True if the device has been connected"""
-        return self.device is not None
+        The snapshot is a dictionary with the number of reports received,
+        states published, reports ignored and reports per channel; the
+        report and publish rates (per second); and latency summaries
+        {count, mean, p50, p99, max} in nanoseconds for decode_ns (arrival
+        to decoded), dispatch_ns (arrival to all callbacks returned) and
+        callback_ns (time spent in callbacks and listeners).
 
-    @property
-    def state(self):
-        """Return the current value of read()
+        If reset is True, the statistics start again from zero.
+        """
+        stats = self._stats
+        if stats is None:
+            return None
+        if reset:
+            self._stats = DeviceStats()
+        return stats.snapshot()
 
-        Returns: state: {t,x,y,z,pitch,yaw,roll,button} namedtuple
-                None if the device is not open.
+    def enable_timing(self, enabled=True, dejitter=False, alpha=0.02):
+        """Estimate the report interval and jitter of each channel, from arrival times
+
+        Parameters:
+            enabled:  if False, stop estimating
+            dejitter: if True, the t of each published state is the de-jittered
+                      time of its report (see ReportClock) rather than its
+                      arrival time; useful for integrating or resampling
+            alpha:    weight of each new interval in the running estimates
         """
-        return self.read()
+        self._clocks = {} if enabled else None
+        self._clock_alpha = alpha
+        self.dejitter = bool(enabled and dejitter)
 
-    def open(self):
-        """Open a connection to the device, if possible"""
-        if self.device:
-            self.device.open()
-        # copy in product details
-        self.product_name = self.device.product_name
-        self.vendor_name = self.device.vendor_name
-        self.version_number = self.device.version_number
-        # doesn't seem to work on 3dconnexion devices...
-        # serial number will be a byte string, we convert to a hex id
-        self.serial_number = "".join(
-            ["%02X" % ord(char) for char in self.device.serial_number]
-        )
+    def timing(self):
+        """Return the interval and jitter estimates, or None if timing is not enabled
 
-    def set_led(self, state):
-        """Set the LED state to state (True or False)"""
-        if self.connected:
-            reports = self.device.find_output_reports()
-            for report in reports:
-                if self.led_usage in report:
-                    report[self.led_usage] = state
-                    report.send()
+        Returns:
+            dict mapping channel -> {reports, interval, rate_hz, jitter}, with
+            interval and jitter in seconds
+        """
+        clocks = self._clocks
+        if clocks is None:
+            return None
+        return {chan: clock.summary() for chan, clock in list(clocks.items())}
 
-    def close(self):
-        """Close the connection, if it is open"""
-        if self.connected:
-            self.device.close()
-            self.device = None
+    def enable_history(self, capacity):
+        """Keep the last capacity states in a SampleHistory ring buffer.
 
-    def read(self):
-        """Return the current state of this navigation controller.
+        A capacity of 0 or None disables the history. Requires NumPy.
+        """
+        self._history = SampleHistory(capacity) if capacity else None
+
+    def history(self, n=None):
+        """Return the most recent n states as an (N, 8) array
+
+        Columns are (t, x, y, z, roll, pitch, yaw, buttons). Returns None if
+        history has not been enabled with enable_history().
+        """
+        if self._history is not None:
+            return self._history.history(n)
+
+    def drain(self):
+        """Return all states received since the last drain() as an (N, 8) array
+
+        Returns None if history has not been enabled with enable_history().
+        """
+        if self._history is not None:
+            return self._history.drain()
+
+    def decode_batch(self, reports, timestamps, frames=True):
+        """Decode a block of raw HID reports in one vectorised pass.
+
+        Reports are decoded as if they had been passed to process() one by one,
+        starting from the current state of this object: values on each channel
+        are carried forward until the next report on that channel, and reports
+        on unmapped channels are dropped. The state of this object is not
+        changed. Requires NumPy.
+
+        Parameters:
+            reports     (N, report_len) uint8 array of raw reports, each starting
+                        with its report ID. Shorter reports should be zero padded.
+            timestamps  length N array of arrival times, written to the "t" field
+            frames      if True, split 6DOF halves are merged: a row is only
+                        emitted for reports on the last axis channel (which
+                        completes a frame) and on button channels. If False, one
+                        row is emitted for every mapped report, as process() does.
 
         Returns:
-            state: {t,x,y,z,pitch,yaw,roll,button} namedtuple
-            None if the device is not open.
+            structured array with fields t, x, y, z, roll, pitch, yaw (float64)
+            and buttons (uint64 bitmask, bit i set if button i is pressed)
         """
-        if self.connected:
-            return self.tuple_state
+        import numpy as np
+
+        reports = np.asarray(reports, dtype=np.uint8)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if reports.ndim != 2 or len(reports) != len(timestamps):
+            raise ValueError("reports must be (N, report_len) with N timestamps")
+        n, width = reports.shape
+        channels = reports[:, 0]
+        rows = np.arange(n)
+        initial = self.snapshot()
+
+        def carried(chan):
+            # for each report, the index of the latest report on chan (or -1)
+            latest = np.where(channels == chan, rows, -1)
+            return np.maximum.accumulate(latest) if n else latest
+
+        dtype = [(name, np.float64) for name in STATE_FIELDS[:-1]]
+        out = np.zeros(n, dtype=dtype + [("buttons", np.uint64)])
+        out["t"] = timestamps
+        for name, (chan, b1, b2, flip) in self.mappings.items():
+            if max(b1, b2) >= width:
+                raise ValueError("reports are too short for axis %s" % name)
+            raw = reports[:, b1].astype(np.uint16) | (
+                reports[:, b2].astype(np.uint16) << 8
+            )
+            values = raw.view(np.int16) * (flip / float(self.axis_scale))
+            latest = carried(chan)
+            out[name] = np.where(
+                latest >= 0, values[np.maximum(latest, 0)], initial[STATE_INDEX[name]]
+            )
+
+        button_channels = sorted(set(b.channel for b in self.button_mapping))
+        out["buttons"] = int(initial[-1])
+        for chan in button_channels:
+            mask = np.zeros(n, dtype=np.uint64)
+            for index, (b_chan, byte, bit) in enumerate(self.button_mapping):
+                if b_chan == chan:
+                    pressed = (reports[:, byte] >> bit) & 1
+                    mask |= pressed.astype(np.uint64) << np.uint64(index)
+            latest = carried(chan)
+            out["buttons"] = np.where(
+                latest >= 0, mask[np.maximum(latest, 0)], out["buttons"]
+            )
+
+        axis_channels = sorted(set(a.channel for a in self.mappings.values()))
+        if frames:
+            emit = axis_channels[-1:] + button_channels
         else:
-            return None
+            emit = axis_channels + button_channels
+        return out[np.isin(channels, emit)]
 
-    def process(self, data):
+    def record(self, path):
+        """Start appending every raw report received to the capture file at path.
+
+        See CaptureWriter for the file format. Any existing recording is stopped.
+
+        Returns:
+            the CaptureWriter
+        """
+        self.stop_recording()
+        self._recorder = CaptureWriter(path, self)
+        return self._recorder
+
+    def stop_recording(self):
+        """Stop recording raw reports, if a recording is running"""
+        recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    def process(self, data, t=None, arrival_ns=None):
         """
         Update the state based on the incoming data
 
         This function updates the state of the DeviceSpec object, giving values for each
         axis [x,y,z,roll,pitch,yaw] in range [-1.0, 1.0]
-        The state tuple is only set when all 6 DoF have been read correctly.
 
-        The timestamp (in fractional seconds since the start of the program)  is written as element "t"
+        If coalesce_frames is set and the axes are split across several channels, the
+        state is only published once every channel has been received, so each published
+        state is one whole 6DOF frame. If the frame is not completed within frame_timeout
+        seconds (from the frame deadline thread), or the same channel arrives twice, the
+        partial frame is published on its own. Button reports are always published at
+        once, with the axes of the last whole frame. Otherwise, the state is published
+        after every report.
+
+        The arrival time of the report (in fractional seconds, on the high_acc_clock
+        timebase) is written as element "t", or its de-jittered time if enabled with
+        enable_timing(dejitter=True)
 
         If callback is provided, it is called on with a copy of the current state tuple.
         If button_callback is provided, it is called only on button state changes with the argument (state, button_state).
 
+        Reports on channels which have no axis or button mappings are ignored.
+
         Parameters:
-            data    The data for this HID event, as returned by the HID callback
+            data        The data for this HID event, as returned by the HID callback
+            t           Arrival time of the report in seconds (e.g. from a recording).
+            arrival_ns  Arrival time of the report in integer ns (clock_ns), as
+                        captured by the transport. Used as the time if t is None;
+                        if both are None, the current time is used. Latency stats
+                        are always measured from arrival_ns, or from now if it is
+                        None, as t may be on another timebase.
 
         """
-        button_changed = False
+        if self.coalesce_frames:
+            with self._frame_lock:
+                self._process(data, t, arrival_ns)
+        else:
+            self._process(data, t, arrival_ns)
 
-        for name, (chan, b1, b2, flip) in self.mappings.items():
-            if data[0] == chan:
-                self.dict_state[name] = (
-                    flip * to_int16(data[b1], data[b2]) / float(self.axis_scale)
-                )
+    def _process(self, data, t, arrival_ns):
+        if t is None:
+            if arrival_ns is None:
+                arrival_ns = clock_ns()
+            t = arrival_ns * 1e-9
+            report_ns = arrival_ns
+        else:
+            report_ns = int(t * 1e9)
+            if arrival_ns is None:
+                arrival_ns = clock_ns()
+        stats = self._stats
+        if stats is not None:
+            self._arrival_ns = arrival_ns
+            stats.reports += 1
+            stats.channels[data[0]] = stats.channels.get(data[0], 0) + 1
+        clocks = self._clocks
+        if clocks is not None:
+            clock = clocks.get(data[0])
+            if clock is None:
+                clock = clocks[data[0]] = ReportClock(self._clock_alpha)
+            dejittered_ns = clock.update(report_ns)
+            if self.dejitter:
+                t = dejittered_ns * 1e-9
+        if self._recorder is not None:
+            # always record the arrival time, so a replay can de-jitter it again
+            self._recorder.write(data, report_ns * 1e-9)
 
-        for button_index, (chan, byte, bit) in enumerate(self.button_mapping):
-            if data[0] == chan:
-                button_changed = True
-                # update the button vector
-                mask = 1 << bit
-                self.dict_state["buttons"][button_index] = (
-                    1 if (data[byte] & mask) != 0 else 0
-                )
+        decoder = self._decoders.get(data[0])
+        if decoder is None:
+            if stats is not None:
+                stats.ignored += 1
+            return
+        unpacker, indices, divisors, extra_axes, buttons = decoder
+        if unpacker is not None and len(data) < unpacker.size:
+            return
+
+        frame_bit = self._frame_bits.get(data[0], 0) if self.coalesce_frames else 0
+        back = self._back
+        if self._pending:
+            # the back buffer already holds part of a frame
+            if frame_bit & self._pending or t - self._frame_start > self.frame_timeout:
+                # the rest of the frame never arrived: publish what we have
+                self._publish()
+                back = self._back
+                back[:] = self._front if self.pipeline is None else self._raw
+        else:
+            # bring the back buffer up to date, then write this report into it
+            # (values are carried forward from the unshaped state if there is a pipeline)
+            back[:] = self._front if self.pipeline is None else self._raw
+
+        if unpacker is not None:
+            values = unpacker.unpack_from(bytes(data))
+            for index, value, divisor in zip(indices, values, divisors):
+                back[index] = value / divisor
+        for index, b1, b2, divisor in extra_axes:
+            back[index] = to_int16(data[b1], data[b2]) / divisor
+
+        if buttons is not None:
+            # replace the bits of the buttons on this channel
+            channel_mask, tables = buttons
+            button_mask = int(back[-1]) & ~channel_mask
+            for byte, table in tables:
+                button_mask |= table[data[byte]]
+            back[-1] = button_mask
+
+        back[0] = t
+        if frame_bit:
+            if not self._pending:
+                self._frame_start = t
+                self._frame_deadline = high_acc_clock() + self.frame_timeout
+                _frame_deadlines.arm(self, self._frame_deadline)
+            self._pending |= frame_bit
+            if self._pending != self._frame_complete:
+                return
+        elif self._pending:
+            # publish the button change on the last whole frame, and keep
+            # assembling the partial one (which already has the new buttons)
+            pending, partial = self._pending, self._partial
+            partial[:] = back
+            back[:] = self._front if self.pipeline is None else self._raw
+            back[0] = t
+            back[-1] = partial[-1]
+            self._publish()
+            self._back[:] = partial
+            self._pending = pending
+            return
+        self._publish()
 
-        self.dict_state["t"] = high_acc_clock()
+    def _expire_frame(self):
+        """Publish a partial frame if its deadline has passed, from the frame deadline thread"""
+        with self._frame_lock:
+            if (
+                self._pending
+                and self.device is not None
+                and high_acc_clock() >= self._frame_deadline
+            ):
+                self._publish()
 
-        # must receive both parts of the 6DOF state before we return the state dictionary
-        if len(self.dict_state) == 8:
-            self.tuple_state = SpaceNavigator(**self.dict_state)
+    def _publish(self):
+        """Swap the back buffer to the front and notify callbacks and listeners"""
+        stats = self._stats
+        if stats is not None:
+            decoded = clock_ns()
+            stats.published += 1
+            stats.decode.record(decoded - self._arrival_ns)
+        front, back = self._front, self._back
+        if self.pipeline is not None:
+            self._raw[:] = back
+            self.pipeline.apply(back)
+        self._version += 1
+        self._front, self._back = back, front
+        self._seq += 1
+        self._version += 1
+        self._pending = 0
+        # wake threads blocked in wait(), only taking the lock if there are any
+        if self._waiters:
+            with self._published:
+                self._published.notify_all()
+        # the buttons which were pressed or released since the last state
+        button_changed = 0
+        if front[-1] != back[-1]:
+            old_buttons = int(front[-1])
+            button_changed = old_buttons ^ int(back[-1])
+        if self._history is not None:
+            self._history.append(back)
+        for listener in self._raw_listeners:
+            listener(back)
 
         # call any attached callbacks
-        if self.callback:
-            self.callback(self.tuple_state)
+        if (
+            self.callback
+            or self._listeners
+            or (self.button_callback and button_changed)
+        ):
+            state = self.tuple_state
+            for listener in self._listeners:
+                listener(state)
+            if self.callback:
+                self.callback(state)
+
+            # only call the button callback if the button state actually changed
+            if self.button_callback and button_changed:
+                self.button_callback(state, state.buttons)
+
+        if button_changed and (self._button_routes or self._chords):
+            self._route_buttons(back[0], old_buttons, int(back[-1]), button_changed)
+
+        if stats is not None:
+            done = clock_ns()
+            stats.callback.record(done - decoded)
+            stats.dispatch.record(done - self._arrival_ns)
+
+    def _route_buttons(self, t, old, new, changed):
+        """Call the button and chord handlers for the buttons in changed"""
+        routes = self._button_routes
+        any_button = routes.get(None, ())
+        events = []
+        while changed:
+            bit = changed & -changed
+            changed ^= bit
+            button = bit.bit_length() - 1
+            event = ButtonEvent(t, button, bool(new & bit), new)
+            events.append(event)
+            for handler in routes.get(button, ()) + any_button:
+                handler(event)
+        for chord, handler in self._chords:
+            # a chord fires when its last button is pressed
+            if new & chord == chord and old & chord != chord:
+                pressed = [e for e in events if e.pressed and (1 << e.button) & chord]
+                handler(pressed[-1])
+
+
+def _spec_field(spec, field):
+    """Read a field from a DeviceSpec, or from a dict of DeviceSpec arguments"""
+    return getattr(spec, field) if isinstance(spec, DeviceSpec) else spec[field]
+
+
+class DeviceSpecs(MutableMapping):
+    """Registry of device specs, indexed by (vendor ID, product ID).
+
+    Finding the spec for a HID device with by_id() is a single dict lookup.
+    The registry also behaves as a mapping of device name -> DeviceSpec;
+    where several products share a name (such as the two product IDs of the
+    SpaceMouse Pro Wireless) the name maps to the first one registered.
+
+    Specs may be registered either as DeviceSpec objects or as dicts of
+    DeviceSpec arguments; a dict is only turned into a DeviceSpec (and its
+    decoders compiled) the first time it is looked up.
+    """
+
+    def __init__(self, entries=()):
+        self._by_id = {}
+        # name -> [(vendor ID, product ID), ...] in registration order
+        self._names = {}
+        self._lock = threading.Lock()
+        for entry in entries:
+            self.register(entry)
+
+    def register(self, spec, name=None):
+        """Add a spec, replacing any registered with the same vendor and product ID
+
+        Parameters:
+            spec: a DeviceSpec, or a dict of DeviceSpec arguments
+            name: the name to register it under; defaults to the spec's name
+        """
+        hid_id = tuple(_spec_field(spec, "hid_id"))
+        name = name or _spec_field(spec, "name")
+        with self._lock:
+            for ids in self._names.values():
+                if hid_id in ids:
+                    ids.remove(hid_id)
+            self._names = {n: ids for n, ids in self._names.items() if ids}
+            self._by_id[hid_id] = spec
+            self._names.setdefault(name, []).append(hid_id)
+
+    def by_id(self, vendor_id, product_id):
+        """Return the DeviceSpec for a vendor and product ID, or None"""
+        entry = self._by_id.get((vendor_id, product_id))
+        if entry is None or isinstance(entry, DeviceSpec):
+            return entry
+        with self._lock:
+            entry = self._by_id[(vendor_id, product_id)]
+            if not isinstance(entry, DeviceSpec):
+                entry = DeviceSpec(**entry)
+                self._by_id[(vendor_id, product_id)] = entry
+            return entry
+
+    def hid_ids(self):
+        """Return a list of the registered (vendor ID, product ID) pairs"""
+        return list(self._by_id)
+
+    def __getitem__(self, name):
+        return self.by_id(*self._names[name][0])
 
-        # only call the button callback if the button state actually changed
-        if self.button_callback and button_changed:
-            self.button_callback(self.tuple_state, self.tuple_state.buttons)
+    def __setitem__(self, name, spec):
+        if name in self._names:
+            del self[name]
+        self.register(spec, name)
 
+    def __delitem__(self, name):
+        with self._lock:
+            for hid_id in self._names.pop(name):
+                del self._by_id[hid_id]
 
-# the IDs for the supported devices
-# Each ID maps a device name to a DeviceSpec object
-device_specs = {
-    "SpaceNavigator": DeviceSpec(
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+
+# the built-in specs for the supported devices, as the arguments of each
+# DeviceSpec; each is only built when it is first looked up. More can be loaded
+# from JSON files with load_device_specs(), or derived from report descriptors.
+device_specs = DeviceSpecs([
+    dict(
         name="SpaceNavigator",
         # vendor ID and product ID
         hid_id=[0x46D, 0xC626],
@@ -236,7 +2599,7 @@ device_specs = {
         ],
         axis_scale=350.0,
     ),
-    "SpaceMouse Compact": DeviceSpec(
+    dict(
         name="SpaceMouse Compact",
         # vendor ID and product ID
         hid_id=[0x256F, 0xC635],
@@ -256,7 +2619,7 @@ device_specs = {
         ],
         axis_scale=350.0,
     ),    
-    "SpaceMouse Pro Wireless": DeviceSpec(
+    dict(
         name="SpaceMouse Pro Wireless",
         # vendor ID and product ID
         hid_id=[0x256F, 0xC632],
@@ -289,8 +2652,8 @@ device_specs = {
         ],  # FIT
         axis_scale=350.0,
     ),
-    # identical, but with 0xc631 device ID
-    "SpaceMouse Pro Wireless": DeviceSpec(
+    # identical, but with 0xc631 device ID; both IDs are in use
+    dict(
         name="SpaceMouse Pro Wireless",
         # vendor ID and product ID
         hid_id=[0x256F, 0xC631],
@@ -323,7 +2686,7 @@ device_specs = {
         ],  # FIT
         axis_scale=350.0,
     ),
-    "SpaceMouse Pro": DeviceSpec(
+    dict(
         name="SpaceMouse Pro",
         # vendor ID and product ID
         hid_id=[0x46D, 0xC62b],
@@ -355,7 +2718,7 @@ device_specs = {
         ],  
         axis_scale=350.0,
     ),
-    "SpaceMouse Wireless": DeviceSpec(
+    dict(
         name="SpaceMouse Wireless",
         # vendor ID and product ID
         hid_id=[0x256F, 0xC62E],
@@ -375,7 +2738,7 @@ device_specs = {
         ],  # FIT
         axis_scale=350.0,
     ),
-    "3Dconnexion Universal Receiver": DeviceSpec(
+    dict(
         name="3Dconnexion Universal Receiver",
         # vendor ID and product ID
         hid_id=[0x256F, 0xC652],
@@ -408,7 +2771,7 @@ device_specs = {
         ],  # FIT
         axis_scale=350.0,
     ),
-    "SpacePilot Pro": DeviceSpec(
+    dict(
         name="SpacePilot Pro",
         # vendor ID and product ID
         hid_id=[0x46D, 0xC629],
@@ -447,33 +2810,1381 @@ device_specs = {
         ], 
         axis_scale=350.0,
     ),
-}
+])
+
+
+# [For the SpaceNavigator]
+# The HID data is in the format
+# [id, a, b, c, d, e, f]
+# each pair (a,b), (c,d), (e,f) is a 16 bit signed value representing the absolute device state [from -350 to 350]
+
+# if id==1, then the mapping is
+# (a,b) = y translation
+# (c,d) = x translation
+# (e,f) = z translation
+
+# if id==2 then the mapping is
+# (a,b) = x tilting (roll)
+# (c,d) = y tilting (pitch)
+# (d,e) = z tilting (yaw)
+
+# if id==3 then the mapping is
+# a = button. Bit 1 = button 1, bit 2 = button 2
+
+# Each movement of the device always causes two HID events, one
+# with id 1 and one with id 2, to be generated, one after the other.
+
+
+_active_device = None
+
+
+## Device spec files
+# A spec file is JSON: either one object or a list of them, like
+# {"name": "SpaceNavigator", "hid_id": ["0x46d", "0xc626"], "led_id": [8, 75],
+#  "axis_scale": 350.0, "mappings": {"x": [channel, byte1, byte2, scale], ...},
+#  "button_mapping": [[channel, byte, bit], ...]}
+# IDs may be integers or hex strings.
+
+
+def spec_to_json(spec):
+    """Return a JSON-serialisable dict describing a DeviceSpec"""
+    return {
+        "name": spec.name,
+        "hid_id": ["0x%04x" % i for i in spec.hid_id],
+        "led_id": list(spec.led_id),
+        "axis_scale": spec.axis_scale,
+        "mappings": {name: list(axis) for name, axis in spec.mappings.items()},
+        "button_mapping": [list(button) for button in spec.button_mapping],
+    }
+
+
+def spec_from_json(data):
+    """Return the DeviceSpec arguments described by a dict from spec_to_json()"""
+
+    def to_int(value):
+        return int(value, 0) if isinstance(value, str) else int(value)
+
+    return dict(
+        name=data["name"],
+        hid_id=[to_int(i) for i in data["hid_id"]],
+        led_id=[to_int(i) for i in data.get("led_id", [LED_PAGE, 0x4B])],
+        mappings={name: AxisSpec(*axis) for name, axis in data["mappings"].items()},
+        button_mapping=[ButtonSpec(*button) for button in data.get("button_mapping", [])],
+        axis_scale=float(data.get("axis_scale", 350.0)),
+    )
+
+
+def load_device_specs(path):
+    """Register the device specs in a JSON spec file, replacing any with the same IDs
+
+    Returns:
+        list of the names of the specs loaded
+    """
+    import json
+
+    with io.open(path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = [data]
+    names = []
+    for entry in data:
+        spec = spec_from_json(entry)
+        device_specs.register(spec)
+        names.append(spec["name"])
+        if spec["name"] not in supported_devices:
+            supported_devices.append(spec["name"])
+    return names
+
+
+def save_device_specs(path, specs):
+    """Write a list of DeviceSpecs to a JSON spec file"""
+    import json
+
+    with io.open(path, "w") as f:
+        json.dump([spec_to_json(spec) for spec in specs], f, indent=2)
+
+
+def _load_env_device_specs():
+    # extra spec files to load at import, separated by os.pathsep; nothing
+    # is read (or imported) unless SPACENAVIGATOR_DEVICES is set
+    for path in os.environ.get("SPACENAVIGATOR_DEVICES", "").split(os.pathsep):
+        if path:
+            load_device_specs(path)
+
+
+# names of the registered specs; load_device_specs() adds to it
+supported_devices = list(device_specs.keys())
+_load_env_device_specs()
+
+
+## HID report descriptors
+# Devices without a spec can still be used if their report descriptor has a
+# multi-axis controller application with the six generic desktop axes as 16
+# bit inputs. The derived spec is cached as JSON in spec_cache_dir(), so each
+# model is only parsed once.
+
+# one field of a report, with its offset in bits from the byte after the report ID
+HIDField = namedtuple(
+    "HIDField",
+    [
+        "kind",
+        "report_id",
+        "usage",
+        "bit_offset",
+        "bit_size",
+        "logical_min",
+        "logical_max",
+        "application",
+    ],
+)
+
+# derive specs for unknown devices from their report descriptors during enumeration
+DERIVE_SPECS = True
+# only devices from these vendors (Logitech, which made the older 3Dconnexion
+# devices, and 3Dconnexion) are parsed, so other HID devices cost nothing
+DERIVE_VENDOR_IDS = (0x46D, 0x256F)
+# (vendor ID, product ID) pairs whose descriptors could not be turned into a spec
+_not_derivable = set()
+
+
+def parse_report_descriptor(descriptor):
+    """Parse a raw HID report descriptor into the fields of its reports.
+
+    Parameters:
+        descriptor: the descriptor bytes
+
+    Returns:
+        list of HIDField, one per data field (constant padding is skipped).
+        kind is "input", "output" or "feature"; usage and application are
+        32 bit usages (page << 16 | usage), application being the usage of
+        the enclosing application collection.
+    """
+    descriptor = bytes(descriptor)
+    kinds = {0x8: "input", 0x9: "output", 0xB: "feature"}
+    state = dict(page=0, logical_min=0, logical_max=0, size=0, count=0, report_id=0)
+    stack = []
+    usages, usage_min = [], None
+    collections = []
+    offsets = {}
+    fields = []
+    i = 0
+    while i < len(descriptor):
+        prefix = descriptor[i]
+        if prefix == 0xFE:
+            # long item: size byte, tag byte, data
+            i += 3 + (descriptor[i + 1] if i + 1 < len(descriptor) else 0)
+            continue
+        size = (0, 1, 2, 4)[prefix & 3]
+        item_type, tag = (prefix >> 2) & 3, prefix >> 4
+        data = descriptor[i + 1 : i + 1 + size]
+        i += 1 + size
+        value = int.from_bytes(data, "little")
+        signed = int.from_bytes(data, "little", signed=True)
+
+        if item_type == 1:
+            # global items
+            if tag == 0x0:
+                state["page"] = value
+            elif tag == 0x1:
+                state["logical_min"] = signed
+            elif tag == 0x2:
+                state["logical_max"] = signed
+            elif tag == 0x7:
+                state["size"] = value
+            elif tag == 0x8:
+                state["report_id"] = value
+            elif tag == 0x9:
+                state["count"] = value
+            elif tag == 0xA:
+                stack.append(dict(state))
+            elif tag == 0xB and stack:
+                state = stack.pop()
+        elif item_type == 2:
+            # local items; 4 byte usages carry their own page
+            usage = value if size == 4 else (state["page"] << 16) | value
+            if tag == 0x0:
+                usages.append(usage)
+            elif tag == 0x1:
+                usage_min = usage
+            elif tag == 0x2 and usage_min is not None:
+                usages.extend(range(usage_min, min(usage, usage_min + 0xFFFF) + 1))
+        elif item_type == 0:
+            # main items
+            if tag in kinds:
+                key = (kinds[tag], state["report_id"])
+                offset = offsets.get(key, 0)
+                application = next((u for t, u in reversed(collections) if t == 1), 0)
+                if not value & 1:
+                    for k in range(state["count"]):
+                        usage = usages[min(k, len(usages) - 1)] if usages else 0
+                        fields.append(
+                            HIDField(
+                                kinds[tag],
+                                state["report_id"],
+                                usage,
+                                offset + k * state["size"],
+                                state["size"],
+                                state["logical_min"],
+                                state["logical_max"],
+                                application,
+                            )
+                        )
+                offsets[key] = offset + state["count"] * state["size"]
+            elif tag == 0xA:
+                collections.append((value, usages[0] if usages else 0))
+            elif tag == 0xC and collections:
+                collections.pop()
+            usages, usage_min = [], None
+    return fields
+
+
+def spec_from_descriptor(descriptor, name, vendor_id, product_id):
+    """Derive DeviceSpec arguments from a HID report descriptor.
+
+    Axes are taken from the 16 bit generic desktop X, Y, Z, Rx, Ry, Rz inputs
+    (see DESCRIPTOR_AXES), buttons from the button page inputs in usage order,
+    the LED from the first LED page output and axis_scale from the axes'
+    logical range.
+
+    Raises:
+        ValueError if the descriptor does not describe a 6DOF multi-axis controller
+    """
+    multi_axis = (GENERIC_PAGE << 16) | MULTI_AXIS_CONTROLLER_CAP
+    mappings, buttons = {}, []
+    led_id, axis_scale = None, 0
+    for field in parse_report_descriptor(descriptor):
+        page, usage = field.usage >> 16, field.usage & 0xFFFF
+        byte = 1 + field.bit_offset // 8
+        if field.application != multi_axis or field.report_id == 0:
+            continue
+        if field.kind == "input" and page == GENERIC_PAGE and usage in DESCRIPTOR_AXES:
+            axis, scale = DESCRIPTOR_AXES[usage]
+            if field.bit_size == 16 and field.bit_offset % 8 == 0 and axis not in mappings:
+                mappings[axis] = AxisSpec(field.report_id, byte, byte + 1, scale)
+                axis_scale = max(axis_scale, abs(field.logical_min), abs(field.logical_max))
+        elif field.kind == "input" and page == BUTTON_PAGE and field.bit_size == 1:
+            buttons.append((usage, ButtonSpec(field.report_id, byte, field.bit_offset % 8)))
+        elif field.kind == "output" and page == LED_PAGE and led_id is None:
+            led_id = [LED_PAGE, usage]
+    if len(mappings) != len(DESCRIPTOR_AXES):
+        raise ValueError("report descriptor does not describe a 6DOF multi-axis controller")
+    return dict(
+        name=name,
+        hid_id=[vendor_id, product_id],
+        led_id=led_id or [LED_PAGE, 0x4B],
+        mappings=mappings,
+        button_mapping=[button for usage, button in sorted(buttons)],
+        axis_scale=float(axis_scale or 350.0),
+    )
+
+
+def spec_cache_dir():
+    """The directory derived specs are cached in: $SPACENAVIGATOR_CACHE, or
+    spacenavigator under $XDG_CACHE_HOME (~/.cache)"""
+    if os.environ.get("SPACENAVIGATOR_CACHE"):
+        return os.environ["SPACENAVIGATOR_CACHE"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "spacenavigator")
+
+
+def derive_spec(device, cache=True):
+    """Register a spec for a HID device which has none, from its report descriptor
+
+    The spec is read from spec_cache_dir() if it was derived before; otherwise
+    the descriptor is parsed and, if cache is True, the spec is written there.
+
+    Parameters:
+        device: a transport device, which may provide get_report_descriptor()
+
+    Returns:
+        the new DeviceSpec, or None if it could not be derived
+    """
+    import json
+
+    hid_id = (device.vendor_id, device.product_id)
+    if hid_id in _not_derivable:
+        return None
+    path = os.path.join(spec_cache_dir(), "%04x_%04x.json" % hid_id)
+    spec = None
+    if cache:
+        try:
+            with io.open(path) as f:
+                spec = spec_from_json(json.load(f)[0])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            spec = None
+    if spec is None:
+        get_descriptor = getattr(device, "get_report_descriptor", None)
+        descriptor = get_descriptor() if get_descriptor is not None else None
+        name = device.product_name or "HID %04x:%04x" % hid_id
+        try:
+            spec = spec_from_descriptor(descriptor or b"", name, *hid_id)
+        except ValueError:
+            _not_derivable.add(hid_id)
+            return None
+        if cache:
+            try:
+                if not os.path.isdir(spec_cache_dir()):
+                    os.makedirs(spec_cache_dir())
+                save_device_specs(path, [DeviceSpec(**spec)])
+            except (IOError, OSError):
+                pass
+    device_specs.register(spec)
+    return device_specs.by_id(*hid_id)
+
+
+## Capture files
+# A capture file is a 64 byte header followed by fixed size records, so that
+# it can be appended to while recording and memory mapped when reading.
+#
+# header: magic, format version, vendor ID, product ID, record size, device name
+# record: arrival time (integer ns on the high_acc_clock timebase), report length,
+#         padding, raw report (zero padded to 64 bytes, starting with the report ID)
+# Longer reports are truncated to 64 bytes, which holds every field the device
+# specs decode, and recorded with the truncated length.
+CAPTURE_MAGIC = b"SNVC"
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct("<4sHHHH48s4x")
+CAPTURE_REPORT_SIZE = 64
+CAPTURE_RECORD = struct.Struct("<qH6x%ds" % CAPTURE_REPORT_SIZE)
+
+CaptureHeader = namedtuple(
+    "CaptureHeader", ["name", "vendor_id", "product_id", "record_size"]
+)
+
+
+class CaptureWriter(object):
+    """Appends raw reports and their arrival times to a capture file.
+
+    If the file already exists, its header must match the device, and new
+    records are appended after the existing ones.
+    """
+
+    def __init__(self, path, spec):
+        self.path = path
+        self.header = CaptureHeader(
+            spec.name, spec.hid_id[0], spec.hid_id[1], CAPTURE_RECORD.size
+        )
+        self._lock = threading.Lock()
+        # io.open, as this module defines its own open()
+        self._file = io.open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(
+                CAPTURE_HEADER.pack(
+                    CAPTURE_MAGIC,
+                    CAPTURE_VERSION,
+                    self.header.vendor_id,
+                    self.header.product_id,
+                    self.header.record_size,
+                    self.header.name.encode("utf8"),
+                )
+            )
+        elif read_capture_header(path) != self.header:
+            self._file.close()
+            raise ValueError("%s is a capture of a different device" % path)
+
+    def write(self, data, t):
+        """Append one report, received at time t (in seconds)"""
+        data = bytes(data[:CAPTURE_REPORT_SIZE])
+        record = CAPTURE_RECORD.pack(int(round(t * 1e9)), len(data), data)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(record)
+
+    def close(self):
+        """Flush and close the capture file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
 
 
-# [For the SpaceNavigator]
-# The HID data is in the format
-# [id, a, b, c, d, e, f]
-# each pair (a,b), (c,d), (e,f) is a 16 bit signed value representing the absolute device state [from -350 to 350]
+def read_capture_header(path):
+    """Return the CaptureHeader of the capture file at path"""
+    with io.open(path, "rb") as f:
+        raw = f.read(CAPTURE_HEADER.size)
+    if len(raw) < CAPTURE_HEADER.size:
+        raise ValueError("%s is not a capture file" % path)
+    magic, version, vid, pid, record_size, name = CAPTURE_HEADER.unpack(raw)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError("%s is not a version %d capture file" % (path, CAPTURE_VERSION))
+    return CaptureHeader(name.rstrip(b"\0").decode("utf8"), vid, pid, record_size)
 
-# if id==1, then the mapping is
-# (a,b) = y translation
-# (c,d) = x translation
-# (e,f) = z translation
 
-# if id==2 then the mapping is
-# (a,b) = x tilting (roll)
-# (c,d) = y tilting (pitch)
-# (d,e) = z tilting (yaw)
+def iter_capture(path):
+    """Iterate over the records of a capture file, yielding (t, report) pairs
 
-# if id==3 then the mapping is
-# a = button. Bit 1 = button 1, bit 2 = button 2
+    t is the arrival time in seconds and report is a bytes object.
+    """
+    header = read_capture_header(path)
+    with io.open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= CAPTURE_HEADER.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            end = len(view) - header.record_size + 1
+            for offset in range(CAPTURE_HEADER.size, end, header.record_size):
+                t_ns, length, data = CAPTURE_RECORD.unpack_from(view, offset)
+                yield t_ns / 1e9, data[:length]
 
-# Each movement of the device always causes two HID events, one
-# with id 1 and one with id 2, to be generated, one after the other.
 
+def load_capture(path):
+    """Memory map a capture file as a NumPy structured array. Requires NumPy.
 
-supported_devices = list(device_specs.keys())
-_active_device = None
+    Returns:
+        (header, records): the CaptureHeader and a read-only array with fields
+        t_ns (int64), length (uint16) and data (64 uint8). records["data"] can
+        be passed directly to DeviceSpec.decode_batch().
+    """
+    import numpy as np
+
+    header = read_capture_header(path)
+    dtype = np.dtype(
+        [("t_ns", "<i8"), ("length", "<u2"), ("pad", "V6"), ("data", "u1", CAPTURE_REPORT_SIZE)]
+    )
+    count = (os.path.getsize(path) - CAPTURE_HEADER.size) // dtype.itemsize
+    if count == 0:
+        return header, np.zeros(0, dtype=dtype)
+    records = np.memmap(
+        path, dtype=dtype, mode="r", offset=CAPTURE_HEADER.size, shape=(count,)
+    )
+    return header, records
+
+
+class CaptureReplay(object):
+    """Replays a capture file through a DeviceSpec, standing in for a HID device.
+
+    The replayed reports go through DeviceSpec.process() with their original
+    arrival times, so callbacks, history and read() behave as they would with
+    the device attached.
+    """
+
+    def __init__(self, path, callback=None, button_callback=None, history=0):
+        self.path = path
+        self.header = read_capture_header(path)
+        # the attributes DeviceSpec.open() expects of a HID device
+        self.vendor_name = "capture"
+        self.product_name = self.header.name
+        self.version_number = CAPTURE_VERSION
+        self.serial_number = ""
+
+        spec = spec_for_device(self.header.vendor_id, self.header.product_id)
+        if spec is None:
+            spec = device_specs.get(self.header.name)
+        if spec is None:
+            raise ValueError("No device spec matches capture %s" % path)
+
+        self.device = copy.deepcopy(spec)
+        self.device.device = self
+        self.device.callback = callback
+        self.device.button_callback = button_callback
+        self.device.enable_history(history)
+        self.device.open()
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def open(self):
+        pass
+
+    def close(self):
+        """Stop a running replay"""
+        self._stop.set()
+
+    def run(self, speed=1.0):
+        """Replay the capture in this thread, returning when it is finished.
+
+        Parameters:
+            speed: playback rate relative to the original timing (2.0 plays at
+                   double speed). If None or 0, reports are fed as fast as possible.
+
+        Returns:
+            the number of reports replayed
+        """
+        self._stop.clear()
+        count = 0
+        start = t0 = None
+        for t, data in iter_capture(self.path):
+            if self._stop.is_set():
+                break
+            if speed:
+                if start is None:
+                    start, t0 = high_acc_clock(), t
+                delay = start + (t - t0) / speed - high_acc_clock()
+                if delay > 0:
+                    sleep(delay)
+            self.device.process(data, t)
+            count += 1
+        return count
+
+    def start(self, speed=1.0):
+        """Replay the capture in a background thread"""
+        self._thread = threading.Thread(target=self.run, args=(speed,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """Wait for a replay started with start() to finish"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+## Transports
+# A transport enumerates the HID devices attached to the machine. Each device it
+# returns has the attributes vendor_id, product_id, vendor_name, product_name,
+# version_number, serial_number and path, and the methods:
+#
+#   open()                          start receiving reports
+#   close()                         stop receiving reports and release the device
+#   set_raw_data_handler(handler)   handler(data, arrival_ns) is called with each raw
+#                                   report, starting with the report ID, and its
+#                                   arrival time from clock_ns()
+#   send_output_report(data)        write a raw output report, starting with its ID
+#   led_report(usage, state)        return the raw output report which sets the LED
+#                                   with the given full usage ID, or None
+
+
+class Transport(object):
+    """Base class for HID transports"""
+
+    name = None
+
+    def enumerate(self):
+        """Return a list of the HID devices currently attached"""
+        raise NotImplementedError
+
+    def change_token(self):
+        """Return a value which changes whenever devices are added or removed.
+
+        Used to decide whether a cached enumeration is still valid. None means
+        the transport can't tell, and enumerations are only cached for
+        ENUMERATION_CACHE_TTL seconds.
+        """
+        return None
+
+    def start_watching(self, handler):
+        """Call handler(action, path) when a device is added ("add") or removed ("remove")
+
+        Raises NotImplementedError if the transport can't watch for device
+        changes; call HotplugMonitor.device_changed() yourself instead.
+        """
+        raise NotImplementedError
+
+    def stop_watching(self):
+        """Stop calling the handler passed to start_watching()"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources (such as reader threads) held by the transport"""
+        pass
+
+
+class OutputQueue(object):
+    """Writes output reports to a transport device from a background thread.
+
+    Queued reports are keyed by report ID: a report replaces any still queued
+    with the same ID, and a report identical to the last one written with
+    that ID is dropped. The writer thread is started by the first put().
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.written = 0
+        # reports which replaced a queued one or matched the last one written
+        self.coalesced = 0
+        self.errors = 0
+        # report ID -> data, in the order the IDs were first queued
+        self._pending = {}
+        # report ID -> the last data taken for writing
+        self._last = {}
+        self._writing = False
+        self._closed = False
+        self._changed = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def put(self, data):
+        """Queue a raw output report, starting with its report ID"""
+        data = bytes(data)
+        report_id = data[0]
+        with self._changed:
+            if self._closed:
+                return
+            # each put() which doesn't add a write is counted once
+            if self._last.get(report_id) == data:
+                # supersedes any queued report, and is already what the device has
+                self._pending.pop(report_id, None)
+                self.coalesced += 1
+                return
+            if report_id in self._pending:
+                self.coalesced += 1
+            self._pending[report_id] = data
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="output reports")
+                self._thread.daemon = True
+                self._thread.start()
+            self._changed.notify_all()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._pending and not self._closed:
+                    self._changed.wait()
+                if not self._pending:
+                    return
+                report_id = next(iter(self._pending))
+                data = self._pending.pop(report_id)
+                self._last[report_id] = data
+                self._writing = True
+            sent = False
+            try:
+                self.device.send_output_report(data)
+                self.written += 1
+                sent = True
+            except Exception:
+                # the device may have been unplugged
+                self.errors += 1
+            with self._changed:
+                if not sent and self._last.get(report_id) is data:
+                    # the device doesn't have it, so the same report must be written again
+                    del self._last[report_id]
+                self._writing = False
+                self._changed.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every queued report has been written
+
+        Returns:
+            True if the queue is empty, False if timeout expired first
+        """
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: not self._pending and not self._writing, timeout
+            )
+
+    def close(self, flush=True):
+        """Stop the writer thread, after writing the queued reports if flush is True"""
+        with self._changed:
+            if not flush:
+                self._pending.clear()
+            self._closed = True
+            self._changed.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class PyWinUSBDevice(object):
+    """Adapts a pywinusb HidDevice to the transport device interface"""
+
+    def __init__(self, device):
+        self.hid_device = device
+        self.vendor_id = device.vendor_id
+        self.product_id = device.product_id
+        self.vendor_name = device.vendor_name
+        self.product_name = device.product_name
+        self.version_number = device.version_number
+        self.serial_number = device.serial_number
+        self.path = device.device_path
+        # report ID -> pywinusb output report, found once the device is open
+        self._output_reports = None
+
+    def open(self):
+        self.hid_device.open()
+        self._output_reports = {
+            report.report_id: report for report in self.hid_device.find_output_reports()
+        }
+
+    def close(self):
+        self.hid_device.close()
+
+    def set_raw_data_handler(self, handler):
+        # pywinusb calls the handler from its reader thread as soon as each
+        # report is read, which is the earliest the arrival time can be taken
+        if handler is None:
+            self.hid_device.set_raw_data_handler(None)
+        else:
+            self.hid_device.set_raw_data_handler(lambda data: handler(data, clock_ns()))
+
+    def send_output_report(self, data):
+        report = (self._output_reports or {}).get(data[0])
+        if report is not None:
+            report.set_raw_data(list(data))
+            report.send()
+
+    def led_report(self, usage, state):
+        for report in (self._output_reports or {}).values():
+            if usage in report:
+                report[usage] = state
+                return report.get_raw_data()
+        return None
+
+
+class PyWinUSBTransport(Transport):
+    """Windows transport using pywinusb. pywinusb runs one reader thread per device."""
+
+    name = "pywinusb"
+
+    def __init__(self):
+        import pywinusb.hid
+
+        self.hid = pywinusb.hid
+
+    def enumerate(self):
+        return [PyWinUSBDevice(dev) for dev in self.hid.find_all_hid_devices() or []]
+
+
+class HidrawDevice(object):
+    """A Linux /dev/hidraw* node, read by its HidrawTransport"""
+
+    def __init__(self, transport, path, vendor_id, product_id, name, serial_number):
+        self.transport = transport
+        self.path = path
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        # the kernel only exposes a combined "vendor product" name
+        self.vendor_name = ""
+        self.product_name = name
+        self.version_number = 0
+        self.serial_number = serial_number
+        self.fd = None
+        self.handler = None
+
+    def open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+            self.transport._register(self)
+
+    def close(self):
+        if self.fd is not None:
+            self.transport._unregister(self)
+
+    def set_raw_data_handler(self, handler):
+        self.handler = handler
+
+    def send_output_report(self, data):
+        if self.fd is not None:
+            os.write(self.fd, bytes(data))
+
+    def led_report(self, usage, state):
+        return [LED_REPORT_ID, 1 if state else 0]
+
+    def get_report_descriptor(self):
+        """Return the raw HID report descriptor from sysfs, or None"""
+        node = os.path.basename(self.path)
+        path = os.path.join(self.transport.sysfs_root, node, "device", "report_descriptor")
+        try:
+            with io.open(path, "rb") as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def _read_reports(self, fd):
+        # read every report queued on the non-blocking descriptor fd (passed in
+        # by the reader thread, as close() may have let go of self.fd already)
+        while True:
+            try:
+                data = os.read(fd, 256)
+            except BlockingIOError:
+                return True
+            except OSError:
+                # device unplugged
+                return False
+            arrival_ns = clock_ns()
+            if not data:
+                return False
+            if self.handler is not None:
+                self.handler(data, arrival_ns)
+
+
+# netlink protocol for kernel device events
+NETLINK_KOBJECT_UEVENT = 15
+
+
+class _UeventSocket(object):
+    """Kernel uevent netlink socket, read by the HidrawTransport reader thread
+    alongside the devices it has open."""
+
+    def __init__(self, transport, handler):
+        import socket
+
+        sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+        )
+        # group 1: events straight from the kernel
+        sock.bind((0, 1))
+        sock.setblocking(False)
+        self.fd = sock.detach()
+        self.transport = transport
+        self.handler = handler
+
+    def _read_reports(self, fd):
+        while True:
+            try:
+                message = os.read(fd, 8192)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # events were lost; everything needs to be rescanned
+                    self.handler("change", None)
+                    continue
+                return False
+            # "action@devpath\0KEY=value\0KEY=value..."
+            info = dict(
+                field.partition("=")[::2]
+                for field in message.decode("utf8", "replace").split("\0")[1:]
+            )
+            if info.get("SUBSYSTEM") == "hidraw" and info.get("ACTION") in (
+                "add",
+                "remove",
+            ):
+                node = os.path.basename(info.get("DEVNAME", ""))
+                self.handler(info["ACTION"], os.path.join(self.transport.dev_root, node))
+
+
+def _read_uevent(path):
+    """Parse a sysfs uevent file into a dictionary"""
+    info = {}
+    try:
+        with io.open(path) as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                info[key] = value
+    except (IOError, OSError):
+        pass
+    return info
+
+
+class HidrawTransport(Transport):
+    """Linux transport using the /dev/hidraw* nodes.
+
+    All open devices are read by a single thread, which multiplexes their
+    non-blocking descriptors with selectors (epoll on Linux). The user needs
+    read/write access to the hidraw nodes, usually granted with a udev rule.
+    """
+
+    name = "hidraw"
+    sysfs_root = "/sys/class/hidraw"
+    dev_root = "/dev"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._selector = None
+        self._thread = None
+        self._wake_fds = None
+        self._closing = []
+        self._uevents = None
+
+    def enumerate(self):
+        devices = []
+        try:
+            nodes = sorted(os.listdir(self.sysfs_root))
+        except OSError:
+            return devices
+        for node in nodes:
+            info = _read_uevent(os.path.join(self.sysfs_root, node, "device", "uevent"))
+            try:
+                bus, vendor_id, product_id = info["HID_ID"].split(":")
+            except (KeyError, ValueError):
+                continue
+            devices.append(
+                HidrawDevice(
+                    self,
+                    os.path.join(self.dev_root, node),
+                    int(vendor_id, 16),
+                    int(product_id, 16),
+                    info.get("HID_NAME", ""),
+                    info.get("HID_UNIQ", ""),
+                )
+            )
+        return devices
+
+    def change_token(self):
+        # hidraw nodes are created and removed in dev_root as devices come and go
+        try:
+            return os.stat(self.dev_root).st_mtime_ns
+        except OSError:
+            return None
+
+    def start_watching(self, handler):
+        """Watch for hidraw nodes being added and removed with a netlink socket.
+
+        The socket is read by the same thread as the devices; handler is also
+        called with "remove" if a device stops responding.
+        """
+        self.stop_watching()
+        self._uevents = _UeventSocket(self, handler)
+        self._register(self._uevents)
+
+    def stop_watching(self):
+        uevents, self._uevents = self._uevents, None
+        if uevents is not None:
+            self._unregister(uevents)
+
+    def _register(self, device):
+        with self._lock:
+            if self._selector is None:
+                self._selector = selectors.DefaultSelector()
+                self._wake_fds = os.pipe()
+                os.set_blocking(self._wake_fds[0], False)
+                self._selector.register(self._wake_fds[0], selectors.EVENT_READ)
+                self._thread = threading.Thread(target=self._run, name="hidraw")
+                self._thread.daemon = True
+                self._thread.start()
+            self._selector.register(device.fd, selectors.EVENT_READ, device)
+
+    def _unregister(self, device):
+        # the device lets go of its descriptor straight away, so it can be
+        # opened again at once; the descriptor itself is closed by the reader
+        # thread, so it never reads one which has been closed (or reused) under it
+        fd, device.fd = device.fd, None
+        if fd is None:
+            return
+        with self._lock:
+            self._closing.append(fd)
+        os.write(self._wake_fds[1], b"\0")
+
+    def _release(self, fd):
+        try:
+            self._selector.unregister(fd)
+        except KeyError:
+            # already released (and closed), so the number may have been reused
+            return
+        os.close(fd)
+
+    def _run(self):
+        selector = self._selector
+        while True:
+            for key, events in selector.select():
+                device = key.data
+                if device is None:
+                    try:
+                        os.read(self._wake_fds[0], 4096)
+                    except BlockingIOError:
+                        pass
+                    with self._lock:
+                        closing, self._closing = self._closing, []
+                    for closed in closing:
+                        if closed is self:
+                            return
+                        self._release(closed)
+                elif device.fd == key.fd and not device._read_reports(key.fd):
+                    device.fd = None
+                    self._release(key.fd)
+                    uevents = self._uevents
+                    if uevents is not None and device is not uevents:
+                        uevents.handler("remove", device.path)
+
+    def close(self):
+        """Close every open device and stop the reader thread"""
+        with self._lock:
+            thread, selector = self._thread, self._selector
+            if thread is None:
+                return
+            for key in list(selector.get_map().values()):
+                if key.data is not None:
+                    if key.data.fd == key.fd:
+                        key.data.fd = None
+                    # devices closed just before may not have been released yet
+                    if key.fd not in self._closing:
+                        self._closing.append(key.fd)
+            self._closing.append(self)
+        os.write(self._wake_fds[1], b"\0")
+        thread.join()
+        for fd in self._wake_fds:
+            os.close(fd)
+        selector.close()
+        self._selector = self._thread = self._wake_fds = None
+
+
+class SimulatedDevice(object):
+    """An in-process stand-in for a HID device, which emits scripted reports.
+
+    Output reports written to the device are kept in output_reports.
+    """
+
+    def __init__(
+        self,
+        vendor_id,
+        product_id,
+        name="",
+        serial_number="",
+        path=None,
+        report_descriptor=None,
+    ):
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.vendor_name = "simulated"
+        self.product_name = name
+        self.version_number = 0
+        self.serial_number = serial_number
+        self.path = path
+        self.handler = None
+        self.is_open = False
+        self.output_reports = []
+        self.report_descriptor = report_descriptor
+        self._stop = threading.Event()
+        self._thread = None
+
+    def open(self):
+        self.is_open = True
+
+    def get_report_descriptor(self):
+        return self.report_descriptor
+
+    def close(self):
+        self._stop.set()
+        self.is_open = False
+
+    def set_raw_data_handler(self, handler):
+        self.handler = handler
+
+    def send_output_report(self, data):
+        self.output_reports.append(bytes(data))
+
+    def led_report(self, usage, state):
+        return [LED_REPORT_ID, 1 if state else 0]
+
+    def emit(self, report):
+        """Deliver one raw report to the handler, in the calling thread"""
+        if self.is_open and self.handler is not None:
+            self.handler(bytes(report), clock_ns())
+
+    def play(self, script, loop=False):
+        """Emit scripted reports from a background thread.
+
+        Parameters:
+            script: sequence of (delay, report) pairs; each report is emitted
+                    delay seconds after the previous one
+            loop:   if True, repeat the script until the device is closed
+        """
+        self._stop.clear()
+
+        def run():
+            while True:
+                for delay, report in script:
+                    if self._stop.wait(delay) if delay > 0 else self._stop.is_set():
+                        return
+                    self.emit(report)
+                if not loop:
+                    return
+
+        self._thread = threading.Thread(target=run, name="simulated device")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """Wait for a script started with play() to finish"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+class SimulatedTransport(Transport):
+    """In-process transport whose devices are added by the caller"""
+
+    name = "simulated"
+
+    def __init__(self):
+        self.devices = []
+        self._changes = 0
+        self._handler = None
+
+    def start_watching(self, handler):
+        self._handler = handler
+
+    def stop_watching(self):
+        self._handler = None
+
+    def change_token(self):
+        return self._changes
+
+    def add_device(self, device="SpaceNavigator", serial_number=""):
+        """Attach a simulated device matching the named entry in device_specs
+
+        Returns:
+            the SimulatedDevice
+        """
+        spec = device_specs[device]
+        simulated = SimulatedDevice(
+            spec.hid_id[0],
+            spec.hid_id[1],
+            spec.name,
+            serial_number,
+            path="simulated:%d" % self._changes,
+        )
+        self.devices.append(simulated)
+        self._changes += 1
+        if self._handler is not None:
+            self._handler("add", simulated.path)
+        return simulated
+
+    def remove_device(self, simulated):
+        """Detach a simulated device, as if it had been unplugged"""
+        simulated.close()
+        self.devices.remove(simulated)
+        self._changes += 1
+        if self._handler is not None:
+            self._handler("remove", simulated.path)
+
+    def enumerate(self):
+        return list(self.devices)
+
+
+_transport = None
+
+
+def get_transport():
+    """Return the transport used when none is passed to open() or list_devices().
+
+    Defaults to pywinusb on Windows and hidraw on Linux; the backend is created
+    on first use.
+    """
+    global _transport
+    if _transport is None:
+        if sys.platform.startswith("win"):
+            _transport = PyWinUSBTransport()
+        elif sys.platform.startswith("linux"):
+            _transport = HidrawTransport()
+        else:
+            raise RuntimeError("No HID transport available for %s" % sys.platform)
+    return _transport
+
+
+def set_transport(transport):
+    """Set the transport used when none is passed to open() or list_devices()"""
+    global _transport
+    _transport = transport
+
+
+# state from one device of a Session; device_id is the index of the device in the session
+TaggedState = namedtuple("TaggedState", ["device_id", "serial_number", "state"])
+
+
+class Session(object):
+    """A set of devices opened from a single enumeration, with one merged stream of states.
+
+    Every state published by any of the devices is tagged with the device's
+    index in the session and its serial number, and put on a single
+    EventQueue. With the hidraw transport all of the devices are read by the
+    same I/O thread. Devices can also be used individually, as session[i].
+
+    Parameters:
+        devices:   which devices to open: a list of device names, serial numbers or indices
+                   into the supported devices found. If None, opens every supported device.
+        transport: the Transport to open the devices with. If None, uses get_transport()
+        callback:  if given, called with each TaggedState on the reader thread
+        maxsize, overflow: size and overflow policy of the merged queue
+        reconnect: if True, devices are reattached after they are unplugged (see HotplugMonitor)
+    """
+
+    def __init__(
+        self,
+        devices=None,
+        transport=None,
+        callback=None,
+        maxsize=256,
+        overflow="drop_oldest",
+        reconnect=False,
+    ):
+        self.transport = transport or get_transport()
+        self.callback = callback
+        self.queue = EventQueue(maxsize, overflow)
+        self.devices = []
+
+        enumeration = _enumerate(self.transport)
+        for index, (spec, hid_device) in enumerate(enumeration.matches):
+            if id(hid_device) in enumeration.in_use:
+                # already opened elsewhere
+                continue
+            if devices is not None and not (
+                index in devices
+                or spec.name in devices
+                or hid_device.serial_number in devices
+                or hex_serial(hid_device.serial_number) in devices
+            ):
+                continue
+            device = copy.deepcopy(spec)
+            device.add_listener(self._make_listener(len(self.devices), device))
+            device.attach(hid_device)
+            enumeration.in_use.add(id(hid_device))
+            if reconnect:
+                get_hotplug_monitor(self.transport).add(device)
+            self.devices.append(device)
+
+    def _make_listener(self, device_id, device):
+        def listener(state):
+            tagged = TaggedState(device_id, device.serial_number, state)
+            self.queue.put(tagged)
+            if self.callback:
+                self.callback(tagged)
+
+        return listener
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __getitem__(self, device_id):
+        return self.devices[device_id]
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def by_serial(self, serial_number):
+        """Return the device with the given serial number (raw or hex), or None"""
+        for device in self.devices:
+            if serial_number in (device.serial_number, device.hid_serial):
+                return device
+
+    def read(self):
+        """Return a list of the current state of each device (None if disconnected)"""
+        return [device.read() for device in self.devices]
+
+    def get(self, timeout=None):
+        """Return the next TaggedState from any device, waiting up to timeout seconds
+
+        Returns None if the timeout expires or the session is closed.
+        """
+        return self.queue.get(timeout)
+
+    def events(self, timeout=None):
+        """Iterate over the TaggedStates of all devices, until the session is closed
+        (or no state arrives within timeout seconds)"""
+        while True:
+            tagged = self.queue.get(timeout)
+            if tagged is None:
+                return
+            yield tagged
+
+    def close(self):
+        """Close every device and end the merged stream"""
+        for device in self.devices:
+            device.close()
+        self.queue.close()
+
+
+class HotplugMonitor(object):
+    """Reattaches DeviceSpecs to their devices after they are unplugged and plugged back in.
+
+    The monitor is driven by the transport's device change notifications (a
+    netlink socket for hidraw), rather than by polling. On arrival, a device
+    with the same vendor and product ID (and serial number, if it has one) is
+    reattached to the existing DeviceSpec, which keeps its callbacks, history
+    and state. Each DeviceSpec's connection_callback(device, connected) is
+    called when it is detached or reattached.
+
+    If the transport can't watch for changes (pywinusb, or hidraw where the
+    netlink socket can't be opened, e.g. in a restricted container), watching
+    is False; call device_changed() from your own device change notification
+    (e.g. WM_DEVICECHANGE).
+    """
+
+    # seconds between attempts to open a device that has just arrived (its
+    # permissions may not have been set up yet), and the number of attempts
+    retry_interval = 0.5
+    retries = 4
+
+    def __init__(self, transport=None):
+        self.transport = transport or get_transport()
+        self.devices = []
+        self._lock = threading.RLock()
+        try:
+            self.transport.start_watching(self.device_changed)
+            self.watching = True
+        except (NotImplementedError, OSError):
+            self.watching = False
+
+    def add(self, device):
+        """Keep device connected"""
+        with self._lock:
+            if device not in self.devices:
+                self.devices.append(device)
+            device.hotplug = self
+
+    def remove(self, device):
+        """Stop reattaching device"""
+        with self._lock:
+            if device in self.devices:
+                self.devices.remove(device)
+            device.hotplug = None
+
+    def _notify(self, device, connected):
+        if device.connection_callback:
+            device.connection_callback(device, connected)
+
+    def device_changed(self, action="change", path=None):
+        """Handle a device change notification
+
+        Parameters:
+            action: "add", "remove", or "change" if unknown
+            path:   the path of the device that changed, if known
+        """
+        invalidate_device_cache(self.transport)
+        with self._lock:
+            if action != "add":
+                present = None
+                if path is None:
+                    present = set(dev.path for dev in self.transport.enumerate())
+                for device in self.devices:
+                    if device.connected and (
+                        device.hid_path == path
+                        or (present is not None and device.hid_path not in present)
+                    ):
+                        device.detach()
+                        self._notify(device, False)
+            if action != "remove":
+                self._reattach(self.retries)
+
+    def _reattach(self, retries):
+        with self._lock:
+            waiting = [device for device in self.devices if not device.connected]
+            if not waiting:
+                return
+            in_use = set(device.hid_path for device in self.devices if device.connected)
+            failed = False
+            for spec, hid_device in _enumerate(self.transport, fresh=True).matches:
+                if hid_device.path in in_use:
+                    continue
+                for device in waiting:
+                    if tuple(device.hid_id) != tuple(spec.hid_id):
+                        continue
+                    if device.hid_serial and device.hid_serial != hid_device.serial_number:
+                        continue
+                    try:
+                        device.attach(hid_device)
+                    except (IOError, OSError):
+                        device.device = None
+                        failed = True
+                        continue
+                    waiting.remove(device)
+                    in_use.add(hid_device.path)
+                    self._notify(device, True)
+                    break
+        if failed and retries > 0:
+            timer = threading.Timer(self.retry_interval, self._reattach, (retries - 1,))
+            timer.daemon = True
+            timer.start()
+
+    def close(self):
+        """Stop watching for device changes"""
+        if self.watching:
+            self.transport.stop_watching()
+        with self._lock:
+            for device in list(self.devices):
+                self.remove(device)
+
+
+_hotplug_monitors = {}
+
+
+def get_hotplug_monitor(transport=None):
+    """Return the HotplugMonitor for transport, creating it if needed"""
+    transport = transport or get_transport()
+    if transport not in _hotplug_monitors:
+        _hotplug_monitors[transport] = HotplugMonitor(transport)
+    return _hotplug_monitors[transport]
 
 
 def close():
@@ -495,26 +4206,100 @@ def read():
         return None
 
 
-def list_devices():
+# how long an enumeration is reused for, if the transport can't tell us when
+# devices have been added or removed
+ENUMERATION_CACHE_TTL = 2.0
+
+# one scan of a transport: its change token and the high_acc_clock time of the
+# scan, [(spec, device), ...] for the supported devices, the number of HID
+# devices found, and the ids of the device objects which have been opened
+Enumeration = namedtuple("Enumeration", ["token", "time", "matches", "hid_count", "in_use"])
+
+# transport -> its latest Enumeration
+_enumeration_cache = {}
+
+
+def spec_for_device(vendor_id, product_id):
+    """Return the entry of device_specs with the given vendor and product ID, or None"""
+    return device_specs.by_id(vendor_id, product_id)
+
+
+def invalidate_device_cache(transport=None):
+    """Forget cached enumerations, so the next list_devices() or open() scans again.
+
+    Call this when devices are plugged in or removed, or after changing device_specs.
+
+    Parameters:
+        transport: only forget the enumeration of this transport. If None, forget all of them.
+    """
+    if transport is None:
+        _enumeration_cache.clear()
+        _not_derivable.clear()
+    else:
+        _enumeration_cache.pop(transport, None)
+
+
+def _enumerate(transport, fresh=False):
+    """Return the cached enumeration entry for transport, scanning if it is stale"""
+    token = transport.change_token()
+    now = high_acc_clock()
+    cached = _enumeration_cache.get(transport)
+    if cached is not None and not fresh:
+        if token is not None:
+            if token == cached.token:
+                return cached
+        elif now - cached.time < ENUMERATION_CACHE_TTL:
+            return cached
+
+    all_hids = transport.enumerate()
+    matches = []
+    for dev in all_hids:
+        spec = spec_for_device(dev.vendor_id, dev.product_id)
+        if spec is None and DERIVE_SPECS and dev.vendor_id in DERIVE_VENDOR_IDS:
+            spec = derive_spec(dev)
+        if spec is not None:
+            matches.append((spec, dev))
+    cached = Enumeration(token, now, matches, len(all_hids), set())
+    _enumeration_cache[transport] = cached
+    return cached
+
+
+def _release_device(device):
+    """Mark a device object from a cached enumeration as no longer in use"""
+    for enumeration in _enumeration_cache.values():
+        enumeration.in_use.discard(id(device))
+
+
+def list_devices(transport=None):
     """Return a list of the supported devices connected
 
+    The enumeration is cached, so an open() straight after this does not scan again.
+
+    Parameters:
+        transport: the Transport to enumerate. If None, uses get_transport()
+
     Returns:
         A list of string names of the devices supported which were found. Empty if no supported devices found
     """
-    devices = []
-    all_hids = hid.find_all_hid_devices()
-    if all_hids:
-        for index, device in enumerate(all_hids):
-            for device_name, spec in device_specs.items():
-                if (
-                    device.vendor_id == spec.hid_id[0]
-                    and device.product_id == spec.hid_id[1]
-                ):
-                    devices.append(device_name)
-    return devices
+    transport = transport or get_transport()
+    return [spec.name for spec, dev in _enumerate(transport).matches]
 
 
-def open(callback=None, button_callback=None, device=None, DeviceNumber=0):
+def open(
+    callback=None,
+    button_callback=None,
+    device=None,
+    DeviceNumber=0,
+    history=0,
+    transport=None,
+    coalesce_frames=False,
+    frame_timeout=0.02,
+    dispatcher=None,
+    max_rate_hz=None,
+    aggregate="last",
+    reconnect=False,
+    connection_callback=None,
+):
     """
     Open a 3D space navigator device. Makes this device the current active device, which enables the module-level read() and close()
     calls. For multiple devices, use the read() and close() calls on the returned object instead, and don't use the module-level calls.
@@ -524,34 +4309,57 @@ def open(callback=None, button_callback=None, device=None, DeviceNumber=0):
         button_callback: If button_callback is provided, it is called on each button push, with the arguments (state_tuple, button_state)
         device: name of device to open. Must be one of the values in supported_devices. If None, chooses the first supported device found.
         DeviceNumber: use the first (DeviceNumber=0) device you find. (for universal wireless receiver)
+        history: if non-zero, keep this many past states in a ring buffer, available via
+                 history() and drain() on the returned object. Requires NumPy.
+        transport: the Transport to open the device with. If None, uses get_transport()
+        coalesce_frames: if True, devices which send translation and rotation on separate channels
+                 only publish a state (and call callback) once both halves have arrived
+        frame_timeout: seconds to wait for the rest of a frame before publishing a lone half
+        dispatcher: a CallbackDispatcher. If given, callback and button_callback are run on its
+                 worker threads rather than on the HID reader thread.
+        max_rate_hz: if given, callback is called at most this many times per second, from a
+                 timer thread, with the states in between combined as set by aggregate
+        aggregate: one of AGGREGATES ("last", "mean" or "peak"), used with max_rate_hz
+        reconnect: if True, the device is reattached automatically when it is unplugged and plugged
+                 back in (see HotplugMonitor)
+        connection_callback: called with (device, connected) when the device is detached or reattached
     Returns:
         Device object if the device was opened successfully
         None if the device could not be opened
     """
     # only used if the module-level functions are used
     global _active_device
+    transport = transport or get_transport()
 
     # if no device name specified, look for any matching device and choose the first
     if device == None:
-        all_devices = list_devices()
+        all_devices = list_devices(transport)
         if len(all_devices) > 0:
             device = all_devices[0]
         else:
             return None
 
-    found_devices = []
-    all_hids = hid.find_all_hid_devices()
-    if all_hids:
-        for index, dev in enumerate(all_hids):
-            spec = device_specs[device]
-            if dev.vendor_id == spec.hid_id[0] and dev.product_id == spec.hid_id[1]:
-                found_devices.append({"Spec":spec,"HIDDevice":dev})
-                print("%s found" % device)
+    def find_devices(fresh=False):
+        enumeration = _enumerate(transport, fresh)
+        found = [
+            {"Spec": spec, "HIDDevice": dev}
+            for spec, dev in enumeration.matches
+            if spec.name == device
+        ]
+        return enumeration, found
 
-    else:
+    enumeration, found_devices = find_devices()
+    if found_devices and len(found_devices) <= DeviceNumber:
+        DeviceNumber = 0
+    if found_devices and id(found_devices[DeviceNumber]["HIDDevice"]) in enumeration.in_use:
+        # this device object is already open; get a fresh one
+        enumeration, found_devices = find_devices(fresh=True)
+
+    if enumeration.hid_count == 0:
         print("No HID devices detected")
         return None
-
+    for found in found_devices:
+        print("%s found" % device)
 
     if len(found_devices) == 0:
         print("No supported devices found")
@@ -565,15 +4373,29 @@ def open(callback=None, button_callback=None, device=None, DeviceNumber=0):
             # create a copy of the device specification
             spec = found_devices[DeviceNumber]["Spec"]
             dev = found_devices[DeviceNumber]["HIDDevice"]
+            enumeration.in_use.add(id(dev))
             new_device = copy.deepcopy(spec)
             new_device.device = dev
 
             # set the callbacks
+            if dispatcher is not None:
+                callback = callback and dispatcher.wrap(callback)
+                button_callback = button_callback and dispatcher.wrap(button_callback)
+            if max_rate_hz:
+                new_device.rate_limiter = new_device.rate_limit(
+                    callback, max_rate_hz, aggregate
+                )
+                callback = None
             new_device.callback = callback
             new_device.button_callback = button_callback
+            new_device.enable_history(history)
+            new_device.coalesce_frames = coalesce_frames
+            new_device.frame_timeout = frame_timeout
+            new_device.connection_callback = connection_callback
             # open the device and set the data handler
-            new_device.open()
-            dev.set_raw_data_handler(lambda x: new_device.process(x))
+            new_device.attach(dev)
+            if reconnect:
+                get_hotplug_monitor(transport).add(new_device)
             _active_device = new_device
             return new_device
 
@@ -0,0 +1,48 @@
+import copy
+
+import spacenavigator
+
+
+def make_device(name="SpaceNavigator"):
+    # a private copy of the spec, fed with reports directly rather than from a transport
+    return copy.deepcopy(spacenavigator.device_specs[name])
+
+
+def test_udp_loopback():
+    dev = make_device()
+    with spacenavigator.UDPSubscriber(("127.0.0.1", 0)) as sub:
+        with dev.publish_udp(sub.address) as publisher:
+            dev.process(bytes([1, 100, 0, 0, 0, 0, 0]), t=1.5)
+            dev.process(bytes([3, 1, 0]), t=1.6)
+            state = None
+            for _ in range(50):
+                state = sub.read(timeout=0.1)
+                if state is not None and state.t > 1.55:
+                    break
+        assert state is not None
+        assert abs(state.t - 1.6) < 1e-6
+        assert abs(state.x - dev.tuple_state.x) < 1.0 / dev.axis_scale
+        assert state.buttons == [1, 0]
+        assert sub.stats()["lost"] == 0
+        assert sub.seq == 1
+        assert publisher.sent == 2
+
+
+def datagram(epoch, seq, t):
+    header = spacenavigator.NET_HEADER.pack(
+        spacenavigator.NET_MAGIC, spacenavigator.NET_VERSION, 1, 2, epoch, 350.0
+    )
+    return header + spacenavigator.NET_FRAME.pack(seq, int(t * 1e9), 0, 0, 0, 0, 0, 0, 0)
+
+
+def test_udp_publisher_restart_resets_sequence():
+    with spacenavigator.UDPSubscriber(("127.0.0.1", 0)) as sub:
+        for seq in range(5):
+            assert sub.process(datagram(1, seq, float(seq))) is not None
+        assert sub.process(datagram(1, 3, 3.0)) is None
+        # a restarted publisher numbers its frames from 0 again
+        state = sub.process(datagram(2, 0, 10.0))
+        assert state is not None
+        assert state.t == 10.0
+        assert sub.seq == 0
+        assert sub.stats() == {"received": 7, "lost": 0, "stale": 1}